@@ -1,8 +1,25 @@
+import collections
+import concurrent.futures
+import contextlib
+import datetime
+import functools
+import itertools
+import logging
 import os
+import random
+import threading
+import time
+import uuid
 
 import boto3
+import botocore.config
+import botocore.exceptions
 import keyring
 
+from . import cache
+
+log = logging.getLogger(__name__)
+
 
 def get_session(access_key='0ZWJV1BMM1Q6GXJ9J2G2'):
     """
@@ -23,7 +40,387 @@ def save_credentials(access_key, secret_key):
     keyring.set_password('AWS', access_key, secret_key)
 
 
+class CallStats:
+    """
+    Thread-safe count and cumulative duration of calls, by name.
+
+    >>> stats = CallStats()
+    >>> stats.record('GetHIT', 0.25)
+    >>> stats.record('GetHIT', 0.5)
+    >>> print(stats)
+    GetHIT: 2 calls, 0.750s total, 0.375s mean
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = collections.Counter()
+        self.durations = collections.Counter()
+
+    def record(self, name, duration):
+        with self.lock:
+            self.counts[name] += 1
+            self.durations[name] += duration
+
+    def __str__(self):
+        return '\n'.join(
+            f'{name}: {count} calls, {self.durations[name]:.3f}s total, '
+            f'{self.durations[name] / count:.3f}s mean'
+            for name, count in sorted(self.counts.items())
+        )
+
+
 class ConnectionFactory:
+    """
+    Supplies a process-wide MTurk client. Clients are thread-safe and
+    keep a pool of HTTP connections, so one is shared by all threads
+    and rebuilt (resolving credentials again) every refresh_interval
+    seconds.
+    """
+
+    refresh_interval = 60 * 60
+    max_pool_connections = 20
+
+    stats = CallStats()
+    "Calls to MTurk by operation, and the time spent constructing clients"
+
+    _client = None
+    _created = 0.0
+    _lock = threading.Lock()
+
     @classmethod
     def get_mturk_connection(class_):
-        return get_session().client('mturk')
+        with class_._lock:
+            expired = time.monotonic() - class_._created > class_.refresh_interval
+            if class_._client is None or expired:
+                class_._client = class_._create_client()
+                class_._created = time.monotonic()
+            return class_._client
+
+    @classmethod
+    def _create_client(class_):
+        start = time.perf_counter()
+        session = get_session() or boto3.Session(region_name='us-east-1')
+        config = botocore.config.Config(
+            max_pool_connections=class_.max_pool_connections,
+            # retries are handled by the Gateway
+            retries=dict(total_max_attempts=1),
+        )
+        client = session.client('mturk', config=config)
+        client.meta.events.register('before-call.mturk', class_._start_call)
+        client.meta.events.register('after-call.mturk', class_._end_call)
+        class_.stats.record('(client construction)', time.perf_counter() - start)
+        return client
+
+    @staticmethod
+    def _start_call(context, **kwargs):
+        context['call_start'] = time.perf_counter()
+
+    @classmethod
+    def _end_call(class_, model, context, **kwargs):
+        if 'call_start' not in context:
+            return
+        duration = time.perf_counter() - context['call_start']
+        class_.stats.record(model.name, duration)
+
+
+class TokenBucket:
+    """
+    A thread-safe token bucket admitting ``rate`` acquisitions per
+    second on average, with bursts of up to ``capacity``.
+
+    The rate adapts to throttling: it's halved (down to min_rate) each
+    time the service throttles a call and recovers by ``recovery`` per
+    successful call (up to max_rate).
+
+    >>> bucket = TokenBucket(rate=4, max_rate=8, min_rate=1)
+    >>> bucket.throttled()
+    >>> bucket.rate
+    2.0
+    >>> bucket.succeeded()
+    >>> bucket.rate
+    2.1
+    """
+
+    def __init__(self, rate, capacity=None, max_rate=None, min_rate=None, recovery=0.1):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.max_rate = max_rate or rate
+        self.min_rate = min_rate or rate / 10
+        self.recovery = recovery
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Take a token, waiting for one if necessary.
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                elapsed, self.updated = now - self.updated, now
+                self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def throttled(self):
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+
+    def succeeded(self):
+        with self.lock:
+            self.rate = round(min(self.max_rate, self.rate + self.recovery), 6)
+
+
+def is_throttling(error):
+    """
+    Is the error one the service raises when calls are too frequent?
+    """
+    codes = {
+        'Throttling',
+        'ThrottlingException',
+        'TooManyRequestsException',
+        'RequestLimitExceeded',
+        'ServiceUnavailable',
+    }
+    return (
+        isinstance(error, botocore.exceptions.ClientError)
+        and error.response.get('Error', {}).get('Code') in codes
+    )
+
+
+def is_insufficient_funds(error):
+    """
+    Is the error MTurk's refusal to create a HIT the account can't
+    pay for? MTurk raises a RequestError carrying its own code as
+    TurkErrorCode alongside the generic error.
+
+    >>> response = dict(Error=dict(Code='RequestError'))
+    >>> response['TurkErrorCode'] = 'AWS.MechanicalTurk.InsufficientFunds'
+    >>> error = botocore.exceptions.ClientError(response, 'CreateHIT')
+    >>> is_insufficient_funds(error)
+    True
+    >>> is_insufficient_funds(ValueError())
+    False
+    """
+    code = 'AWS.MechanicalTurk.InsufficientFunds'
+    if not isinstance(error, botocore.exceptions.ClientError):
+        return False
+    codes = (
+        error.response.get('Error', {}).get('Code'),
+        error.response.get('TurkErrorCode'),
+    )
+    return code in codes
+
+
+class Gateway:
+    """
+    All calls to MTurk go through the gateway, which limits how many
+    are in flight, rate-limits them with an adaptive TokenBucket and
+    retries throttled or failed connections with jittered exponential
+    backoff.
+    """
+
+    def __init__(self, max_concurrency=10, rate=5.0, max_attempts=6, backoff=0.25):
+        self.max_concurrency = max_concurrency
+        self.slots = threading.BoundedSemaphore(max_concurrency)
+        self.bucket = TokenBucket(rate=rate, min_rate=rate / 20)
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+
+    def call(self, operation, **params):
+        """
+        Invoke operation (a method of the MTurk client) with params.
+        """
+        for attempt in itertools.count(1):
+            try:
+                return self._attempt(operation, params)
+            except botocore.exceptions.ConnectionError:
+                if attempt >= self.max_attempts:
+                    raise
+            except botocore.exceptions.ClientError as error:
+                if not is_throttling(error) or attempt >= self.max_attempts:
+                    raise
+                self.bucket.throttled()
+            # full jitter
+            time.sleep(random.uniform(0, self.backoff * 2**attempt))
+
+    def _attempt(self, operation, params):
+        with self.slots:
+            self.bucket.acquire()
+            client = ConnectionFactory.get_mturk_connection()
+            result = getattr(client, operation)(**params)
+        self.bucket.succeeded()
+        return result
+
+    def map(self, operation, params_seq):
+        """
+        Call operation once for each dict of params in params_seq,
+        concurrently, returning the results in order.
+        """
+        return self.each(functools.partial(self._call_params, operation), params_seq)
+
+    def each(self, func, items):
+        """
+        Call func (which calls the gateway) on each of items,
+        concurrently, returning the results in order.
+        """
+        with concurrent.futures.ThreadPoolExecutor(self.max_concurrency) as pool:
+            return list(pool.map(func, items))
+
+    def _call_params(self, operation, params):
+        return self.call(operation, **params)
+
+    def paginate(self, operation, result_key, prefetch=False, **params):
+        """
+        Lazily yield the items under result_key from each page of
+        results of operation, following NextToken. If prefetch, fetch
+        the next page in the background while the current one is being
+        consumed, so at most two pages are held in memory.
+        """
+        with concurrent.futures.ThreadPoolExecutor(1) as pool:
+            response = self.call(operation, **params)
+            while True:
+                token = response.get('NextToken')
+                fetch = functools.partial(
+                    self.call, operation, NextToken=token, **params
+                )
+                next_page = pool.submit(fetch) if token and prefetch else None
+                yield from response[result_key]
+                if not token:
+                    return
+                response = next_page.result() if next_page else fetch()
+
+    def get_hits(self, hit_ids):
+        """
+        Fetch the HIT for each of hit_ids.
+        """
+        params = [dict(HITId=hit_id) for hit_id in hit_ids]
+        return [resp['HIT'] for resp in self.map('get_hit', params)]
+
+    def list_assignments(self, hit_ids):
+        """
+        Fetch the assignments for each of hit_ids.
+        """
+        params = [dict(HITId=hit_id) for hit_id in hit_ids]
+        responses = self.map('list_assignments_for_hit', params)
+        return [resp['Assignments'] for resp in responses]
+
+    def disable_hits(self, hit_ids):
+        """
+        Take each of hit_ids off the market by expiring it, then delete
+        those that can be deleted (HITs with assignments awaiting review
+        cannot). Return the number of HITs disabled.
+        """
+        expired = datetime.datetime(2015, 1, 1)
+        params = [dict(HITId=hit_id, ExpireAt=expired) for hit_id in hit_ids]
+        self.map('update_expiration_for_hit', params)
+        self.each(self._delete_hit, hit_ids)
+        return len(params)
+
+    def _delete_hit(self, hit_id):
+        try:
+            self.call('delete_hit', HITId=hit_id)
+        except botocore.exceptions.ClientError as error:
+            log.warning("Unable to delete HIT %s: %s", hit_id, error)
+
+
+gateway = Gateway()
+
+
+class Reservations:
+    """
+    Funds reserved in this process.
+    """
+
+    def __init__(self):
+        self.amounts = {}
+        self.lock = threading.Lock()
+
+    def add(self, token, amount):
+        with self.lock:
+            self.amounts[token] = amount
+
+    def remove(self, token):
+        with self.lock:
+            del self.amounts[token]
+
+    def total(self):
+        with self.lock:
+            return sum(self.amounts.values())
+
+
+class SharedReservations:
+    """
+    Funds reserved by all server processes, in the database.
+    Reservations not removed (by a process that died) expire after
+    ``ttl`` seconds through a TTL index (see persistence.indexes).
+    """
+
+    ttl = 60 * 60
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def add(self, token, amount):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        self.collection.insert_one(dict(_id=token, amount=amount, reserved=now))
+
+    def remove(self, token):
+        self.collection.delete_one({'_id': token})
+
+    def total(self):
+        group = {'$group': {'_id': None, 'total': {'$sum': '$amount'}}}
+        results = self.collection.aggregate([group])
+        return next((result['total'] for result in results), 0)
+
+
+class AccountBalance:
+    """
+    The MTurk account balance, shared by all request threads and
+    fetched at most once every ``ttl`` seconds. Funds reserved for
+    jobs being authorized are deducted from the balance available;
+    once init is called, that includes those reserved by other server
+    processes.
+    """
+
+    def __init__(self, ttl=60, gateway=gateway):
+        self.cache = cache.TTLCache(ttl)
+        self.gateway = gateway
+        self.reservations = Reservations()
+
+    def _fetch(self):
+        return float(self.gateway.call('get_account_balance')['AvailableBalance'])
+
+    def available(self):
+        balance = self.cache.get('balance', self._fetch)
+        return balance - self.reservations.total()
+
+    @contextlib.contextmanager
+    def reserve(self, key, amount):
+        """
+        Reserve amount for key (such as a job id) for the duration of
+        the context. Each reservation is separate, even for the same key.
+        As the spending is then reflected by MTurk, the cached balance
+        is invalidated on exit.
+        """
+        token = f'{key}-{uuid.uuid4().hex}'
+        self.reservations.add(token, amount)
+        try:
+            yield
+        finally:
+            self.reservations.remove(token)
+            self.cache.invalidate('balance')
+
+
+balance = AccountBalance()
+
+
+def init(db):
+    """
+    Share the funds reserved with the other server processes.
+    """
+    balance.reservations = SharedReservations(db.balance_reservations)
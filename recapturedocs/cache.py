@@ -0,0 +1,158 @@
+"""
+In-process caches shared across request threads.
+"""
+
+import collections
+import concurrent.futures
+import threading
+import time
+
+
+class SizedLRU:
+    """
+    A thread-safe least-recently-used cache bounded by the total size
+    of its values rather than their number.
+
+    >>> cache = SizedLRU(max_size=10)
+    >>> cache['a'] = b'12345'
+    >>> cache['b'] = b'1234'
+    >>> cache.get('a')
+    b'12345'
+    >>> cache['c'] = b'123'
+    >>> cache.get('b') is None
+    True
+    >>> sorted(cache.keys())
+    ['a', 'c']
+    >>> cache.total
+    8
+
+    Values larger than the cache are never stored.
+
+    >>> cache['big'] = b'x' * 11
+    >>> 'big' in cache
+    False
+    """
+
+    def __init__(self, max_size, size=len):
+        self.max_size = max_size
+        self.size = size
+        self.data = collections.OrderedDict()
+        self.total = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.data:
+                return default
+            self.data.move_to_end(key)
+            return self.data[key]
+
+    def __setitem__(self, key, value):
+        size = self.size(value)
+        if size > self.max_size:
+            return
+        with self.lock:
+            self._discard(key)
+            self.data[key] = value
+            self.total += size
+            while self.total > self.max_size:
+                self._discard(next(iter(self.data)))
+
+    def pop(self, key, default=None):
+        with self.lock:
+            value = self.data.get(key, default)
+            self._discard(key)
+            return value
+
+    def _discard(self, key):
+        if key in self.data:
+            self.total -= self.size(self.data.pop(key))
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+    def keys(self):
+        return list(self.data)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.total = 0
+
+
+class TTLCache:
+    """
+    A thread-safe cache of computed values that expire ``ttl`` seconds
+    after they're computed. Concurrent requests for a missing or expired
+    key share a single computation.
+
+    >>> calls = []
+    >>> cache = TTLCache(ttl=60)
+    >>> cache.get('key', lambda: calls.append(1) or len(calls))
+    1
+    >>> cache.get('key', lambda: calls.append(1) or len(calls))
+    1
+    >>> cache.invalidate('key')
+    >>> cache.get('key', lambda: calls.append(1) or len(calls))
+    2
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.values = {}
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def get(self, key, compute):
+        future, leader = self._claim(key)
+        if leader:
+            self._compute(key, compute, future)
+        return future.result()
+
+    def submit(self, key, compute, executor):
+        """
+        Return a future for the value for key, computed in executor if
+        it's missing or expired. Callers waiting on a computation in
+        progress share its future, so they don't occupy the executor.
+        """
+        future, leader = self._claim(key)
+        if leader:
+            executor.submit(self._compute, key, compute, future)
+        return future
+
+    def _claim(self, key):
+        """
+        Return a future for the value for key and whether the caller
+        must compute it.
+        """
+        with self.lock:
+            if key in self.values:
+                value, expires = self.values[key]
+                if time.monotonic() < expires:
+                    future = concurrent.futures.Future()
+                    future.set_result(value)
+                    return future, False
+            leader = key not in self.pending
+            if leader:
+                self.pending[key] = concurrent.futures.Future()
+            return self.pending[key], leader
+
+    def _compute(self, key, compute, future):
+        try:
+            value = compute()
+        except BaseException as error:
+            with self.lock:
+                del self.pending[key]
+            future.set_exception(error)
+            return
+        with self.lock:
+            self.values[key] = value, time.monotonic() + self.ttl
+            del self.pending[key]
+        future.set_result(value)
+
+    def invalidate(self, key):
+        with self.lock:
+            self.values.pop(key, None)
@@ -0,0 +1,198 @@
+"""
+Supervision of several server processes, each listening on its own
+port, as members of a load balancer's pool (see ubuntu/nginx config).
+"""
+
+import contextlib
+import logging
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+log = logging.getLogger(__name__)
+
+
+def worker_config(port, primary):
+    """
+    Config overriding the port for a worker. Background tasks that
+    should run only once (HIT polling, Dropbox sync) run only in the
+    primary worker.
+
+    >>> print(worker_config(5002, primary=False))
+    [global]
+    server.socket_port = 5002
+    <BLANKLINE>
+    [hit_poller]
+    on = False
+    <BLANKLINE>
+    [dropbox_sync]
+    on = False
+    <BLANKLINE>
+    """
+    config = f'[global]\nserver.socket_port = {port}\n'
+    if not primary:
+        config += '\n[hit_poller]\non = False\n'
+        config += '\n[dropbox_sync]\non = False\n'
+    return config
+
+
+def wait_listening(host, port, timeout=60):
+    """
+    Wait until something accepts connections on host and port.
+    """
+    if host in ('', '::', '::0', '0.0.0.0'):
+        host = 'localhost'
+    deadline = time.monotonic() + timeout
+    while True:
+        with contextlib.suppress(OSError):
+            socket.create_connection((host, port), timeout=1).close()
+            return True
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.2)
+
+
+class Worker:
+    min_uptime = 10
+    "Seconds a worker must run for its exit not to count as a crash"
+
+    max_backoff = 60
+    "Most seconds to wait before restarting a crashing worker"
+
+    def __init__(self, index, port, primary, args):
+        self.index = index
+        self.port = port
+        self.args = args
+        self.config = tempfile.NamedTemporaryFile(
+            'w', prefix=f'worker-{index}-', suffix='.conf', delete=False
+        )
+        with self.config:
+            self.config.write(worker_config(port, primary))
+        self.process = None
+        self.started = None
+        self.restart_at = None
+        self.crashes = 0
+
+    def start(self):
+        env = dict(os.environ)
+        # the args are given explicitly
+        env.pop('COMMAND_LINE_ARGS', None)
+        cmd = [sys.executable, '-m', 'recapturedocs.server', 'serve']
+        cmd += [*self.args, self.config.name]
+        self.process = subprocess.Popen(cmd, env=env)
+        self.started = time.monotonic()
+        self.restart_at = None
+        log.info(
+            "Started worker %d (pid %d) on port %d", self.index, self.pid, self.port
+        )
+
+    @property
+    def pid(self):
+        return self.process.pid
+
+    def running(self):
+        return self.process is not None and self.process.poll() is None
+
+    def backoff(self):
+        """
+        Seconds to wait before restarting the worker, which has exited:
+        none if it ran for min_uptime, otherwise doubling with each
+        consecutive crash, up to max_backoff.
+        """
+        if time.monotonic() - self.started >= self.min_uptime:
+            self.crashes = 0
+            return 0
+        self.crashes += 1
+        return min(self.max_backoff, 2 ** (self.crashes - 1))
+
+    def stop(self, timeout=30):
+        """
+        Stop the worker, letting it finish requests in progress.
+        """
+        if not self.running():
+            return
+        self.process.terminate()
+        try:
+            self.process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            log.warning("Worker %d did not stop; killing it", self.index)
+            self.process.kill()
+            self.process.wait()
+
+    def close(self):
+        self.stop()
+        os.remove(self.config.name)
+
+
+class Supervisor:
+    """
+    Runs ``workers`` server processes on consecutive ports from
+    base_port, each with the config files in args, restarting any
+    that exit. On SIGHUP, the workers are restarted one at a time,
+    each after the last is accepting connections again, so the pool
+    keeps serving throughout. SIGTERM or SIGINT stops the workers.
+    """
+
+    check_interval = 1
+
+    def __init__(self, workers, base_port, host, args):
+        self.host = host
+        self.workers = [
+            Worker(index, base_port + index, index == 0, args)
+            for index in range(workers)
+        ]
+        self.reload_requested = False
+        self.stopping = False
+
+    def run(self):
+        signal.signal(signal.SIGHUP, self._request_reload)
+        signal.signal(signal.SIGTERM, self._request_stop)
+        signal.signal(signal.SIGINT, self._request_stop)
+        try:
+            for worker in self.workers:
+                worker.start()
+            while not self.stopping:
+                if self.reload_requested:
+                    self.reload_requested = False
+                    self.reload()
+                self.restart_exited()
+                time.sleep(self.check_interval)
+        finally:
+            for worker in self.workers:
+                worker.close()
+
+    def restart_exited(self):
+        """
+        Restart workers that exited, after a backoff for those that
+        keep crashing (see Worker.backoff).
+        """
+        now = time.monotonic()
+        for worker in self.workers:
+            if worker.running() or self.stopping:
+                continue
+            if worker.restart_at is None:
+                delay = worker.backoff()
+                worker.restart_at = now + delay
+                log.warning("Worker %d exited; restarting in %ds", worker.index, delay)
+            if now >= worker.restart_at:
+                worker.start()
+
+    def reload(self):
+        log.info("Restarting workers")
+        for worker in self.workers:
+            if self.stopping:
+                return
+            worker.stop()
+            worker.start()
+            if not wait_listening(self.host, worker.port):
+                log.error("Worker %d not listening on %d", worker.index, worker.port)
+
+    def _request_reload(self, signum, frame):
+        self.reload_requested = True
+
+    def _request_stop(self, signum, frame):
+        self.stopping = True
@@ -0,0 +1,170 @@
+"""
+A typed, versioned encoding of the persistent model objects as plain
+Mongo documents.
+
+Each class registered here declares a ``schema`` mapping the names of
+its persistent attributes to fields, which convert the values to and
+from BSON-compatible values. Documents are tagged with the class name
+and schema version. Documents without a tag were saved by the
+reflective jsonpickle encoder (jaraco.modb) and are decoded by it.
+"""
+
+import functools
+import timeit
+
+import bson
+import jaraco.modb
+
+from . import pages
+
+version = 1
+"The schema version written by encode"
+
+registry = {}
+
+
+def register(cls):
+    """
+    Class decorator registering cls for encoding by its schema.
+    """
+    registry[cls.__name__] = cls
+    return cls
+
+
+def encode(obj):
+    cls = type(obj)
+    if registry.get(cls.__name__) is not cls:
+        raise TypeError(f"{cls.__name__} is not registered for encoding")
+    doc = {'_type': cls.__name__, '_version': version}
+    state = vars(obj)
+    for name, field in cls.schema.items():
+        if name in state:
+            doc[name] = field.encode(state[name])
+    return doc
+
+
+def encode_fields(obj, names):
+    """
+    Encode only the named attributes of obj (those it has), for a
+    partial update of its document.
+    """
+    state = vars(obj)
+    schema = type(obj).schema
+    return {name: schema[name].encode(state[name]) for name in names if name in state}
+
+
+def decode(doc):
+    if '_type' not in doc:
+        return jaraco.modb.decode(doc)
+    if doc['_version'] > version:
+        raise ValueError(f"Unsupported schema version {doc['_version']}")
+    cls = registry[doc['_type']]
+    obj = cls.__new__(cls)
+    state = vars(obj)
+    for name, field in cls.schema.items():
+        if name in doc:
+            state[name] = field.decode(doc[name])
+    return obj
+
+
+class Field:
+    """
+    A value stored as is (str, number, bool, datetime or None).
+    """
+
+    def encode(self, value):
+        return value
+
+    def decode(self, value):
+        return value
+
+
+class Objects(Field):
+    """
+    A list of registered objects.
+    """
+
+    def encode(self, value):
+        return list(map(encode, value))
+
+    def decode(self, value):
+        return list(map(decode, value))
+
+
+class Pages(Field):
+    """
+    The pages of a job: references into the page store, or (for pages
+    not moved to the store) the page content as binary.
+
+    >>> Pages().encode(pages.PageList(['a', 'b']))
+    {'refs': ['a', 'b']}
+    >>> Pages().decode(Pages().encode([b'page']))
+    [b'page']
+    """
+
+    def encode(self, value):
+        if isinstance(value, pages.PageList):
+            return dict(refs=value.refs)
+        return dict(content=list(value))
+
+    def decode(self, value):
+        if 'refs' in value:
+            return pages.PageList(value['refs'])
+        return value['content']
+
+
+def benchmark(page_count=50, number=200, page_size=2**14):
+    """
+    Compare the size of a job encoded as BSON and the time to encode
+    and decode it using this codec and using jaraco.modb, for a job
+    whose pages are in the page store and one whose pages (of
+    page_size bytes) are embedded in the document.
+    """
+    from . import jsonpickle, model
+
+    jsonpickle.setup_handlers()
+    # the codec the models registered with (not __main__'s, if run as a script)
+    codec = model.codec
+    encoders = dict(
+        codec=(codec.encode, codec.decode), modb=(jaraco.modb.encode, codec.decode)
+    )
+    layouts = dict(
+        refs=pages.PageList(pages.page_ref(bytes([n])) for n in range(page_count)),
+        content=[bytes([n]) * page_size for n in range(page_count)],
+    )
+    for layout, job_pages in layouts.items():
+        job = _benchmark_job(model, job_pages)
+        for name, (encode_, decode_) in encoders.items():
+            data = bson.encode(encode_(job))
+            round_trip = functools.partial(_round_trip, job, encode_, decode_)
+            duration = timeit.timeit(round_trip, number=number) / number
+            print(
+                f'{layout} {name}: {len(data):,} bytes, '
+                f'{duration * 1000:.2f} ms per round trip'
+            )
+
+
+def _benchmark_job(model, job_pages):
+    job = model.MTurkConversionJob.__new__(model.MTurkConversionJob)
+    vars(job).update(
+        created=None,
+        upload_hash='0' * 32,
+        content_type='application/pdf',
+        filename='bench.pdf',
+        server_url='http://localhost/',
+        authorized=True,
+        pages=job_pages,
+        _hash='0' * 32,
+    )
+    job.hits = [model.RetypePageHIT(job.server_url) for _ in range(len(job_pages))]
+    for hit in job.hits:
+        hit.registration_result = dict(HIT=dict(HITId='0' * 30, Reward='0.70'))
+    return job
+
+
+def _round_trip(obj, encode, decode):
+    decode(bson.decode(bson.encode(encode(obj))))
+
+
+if __name__ == '__main__':
+    benchmark()
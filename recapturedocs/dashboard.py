@@ -0,0 +1,235 @@
+"""
+Queries behind the admin job dashboard. Jobs are listed a page at a
+time from their summaries (see model.ConversionJob._summary), and
+totals are computed by Mongo, so a request transfers only one page of
+jobs however many are in the database.
+"""
+
+import datetime
+
+from . import model, persistence
+
+page_size = 50
+
+
+def parse_flag(value):
+    """
+    Parse an optional yes/no filter from a query string.
+
+    >>> parse_flag(''), parse_flag('yes'), parse_flag('false')
+    (None, True, False)
+    """
+    flags = {'': None, 'yes': True, 'true': True, 'no': False, 'false': False}
+    try:
+        return flags[(value or '').lower()]
+    except KeyError:
+        raise ValueError(f"Invalid flag {value!r}") from None
+
+
+def parse_date(value, days=0):
+    """
+    Parse an optional date (YYYY-MM-DD) as a datetime, offset by days.
+
+    >>> parse_date('2024-05-01', days=1)
+    datetime.datetime(2024, 5, 2, 0, 0)
+    >>> parse_date('') is None
+    True
+    """
+    if not value:
+        return None
+    date = datetime.date.fromisoformat(value) + datetime.timedelta(days=days)
+    return datetime.datetime.combine(date, datetime.time())
+
+
+def job_filter(authorized=None, since=None, until=None):
+    """
+    Build the query for jobs matching the filters. since and until
+    are datetimes bounding when the job was created.
+
+    >>> job_filter(authorized=True)
+    {'summary': {'$exists': True}, 'summary.authorized': True}
+    """
+    query = {'summary': {'$exists': True}}
+    if authorized is not None:
+        query['summary.authorized'] = authorized
+    created = {}
+    if since is not None:
+        created['$gte'] = since
+    if until is not None:
+        created['$lt'] = until
+    if created:
+        query['summary.created'] = created
+    return query
+
+
+def _progress():
+    """
+    Pipeline stages adding to each job the number of its HITs not yet
+    complete and whether the job as a whole is complete.
+    """
+    registered = {
+        '$size': {
+            '$filter': {
+                'input': {'$ifNull': ['$summary.hit_ids', []]},
+                'cond': {'$ne': ['$$this', None]},
+            }
+        }
+    }
+    outstanding = [
+        {'$match': {'$expr': {'$eq': ['$job_id', '$$id']}, 'complete': {'$ne': True}}},
+        {'$count': 'count'},
+    ]
+    complete = {
+        '$and': [
+            {'$eq': ['$summary.authorized', True]},
+            {'$eq': [registered, '$summary.page_count']},
+            {'$eq': ['$outstanding', 0]},
+        ]
+    }
+    return [
+        {
+            '$lookup': {
+                'from': 'hits',
+                'let': {'id': '$_id'},
+                'pipeline': outstanding,
+                'as': 'outstanding',
+            }
+        },
+        {
+            '$addFields': {
+                'outstanding': {
+                    '$ifNull': [{'$arrayElemAt': ['$outstanding.count', 0]}, 0]
+                }
+            }
+        },
+        {'$addFields': {'complete': complete}},
+    ]
+
+
+def encode_cursor(data):
+    """
+    The cursor for the page following the job in data.
+
+    >>> created = datetime.datetime(2024, 5, 1, 12, 30)
+    >>> encode_cursor(dict(_id='abc', summary=dict(created=created)))
+    '2024-05-01T12:30:00_abc'
+    """
+    return '{}_{}'.format(data['summary']['created'].isoformat(), data['_id'])
+
+
+def decode_cursor(cursor):
+    """
+    Return the query for jobs following the cursor (newest first).
+
+    >>> decode_cursor('2024-05-01T12:30:00_abc')['$or'][1]
+    {'summary.created': datetime.datetime(2024, 5, 1, 12, 30), '_id': {'$lt': 'abc'}}
+    """
+    created, sep, id = cursor.rpartition('_')
+    created = datetime.datetime.fromisoformat(created)
+    return {
+        '$or': [
+            {'summary.created': {'$lt': created}},
+            {'summary.created': created, '_id': {'$lt': id}},
+        ]
+    }
+
+
+class Dashboard:
+    """
+    One page of jobs matching a query, newest first, with totals over
+    all matching jobs.
+
+    The page is read from the ``created`` index (see persistence.indexes),
+    and the progress of only the jobs on the page is looked up, unless
+    filtering on completion, which requires the progress of every
+    matching job.
+    """
+
+    def __init__(
+        self,
+        query,
+        complete=None,
+        after=None,
+        limit=page_size,
+        job_class=model.MTurkConversionJob,
+    ):
+        self.job_class = job_class
+        self.limit = limit
+        page_query = {'$and': [query, decode_cursor(after)]} if after else query
+        docs = persistence.store.jobs.aggregate(self._page(page_query, complete))
+        self._load(list(docs), self._totals(query, complete))
+
+    def _page(self, query, complete):
+        pipeline = [
+            {'$match': query},
+            {'$sort': {'summary.created': -1, '_id': -1}},
+        ]
+        # one more than the page, to tell whether there's a next page
+        limit = [{'$limit': self.limit + 1}]
+        progress = [{'$project': {'summary': True}}, *_progress()]
+        if complete is None:
+            return pipeline + limit + progress
+        return pipeline + progress + [{'$match': {'complete': complete}}] + limit
+
+    def _totals(self, query, complete):
+        group = {
+            '$group': {
+                '_id': None,
+                'jobs': {'$sum': 1},
+                'pages': {'$sum': '$summary.page_count'},
+                'outstanding': {'$sum': '$outstanding'},
+            }
+        }
+        if complete is not None:
+            pipeline = [{'$match': query}, {'$project': {'summary': True}}]
+            pipeline += _progress()
+            pipeline += [{'$match': {'complete': complete}}, group]
+            return dict(*persistence.store.jobs.aggregate(pipeline))
+        del group['$group']['outstanding']
+        totals = dict(*persistence.store.jobs.aggregate([{'$match': query}, group]))
+        totals['outstanding'] = self._outstanding(query)
+        return totals
+
+    @staticmethod
+    def _outstanding(query):
+        """
+        Count the outstanding HITs of jobs matching query, starting
+        from the outstanding HITs (see persistence.indexes), which are
+        far fewer than the jobs.
+        """
+        job = [
+            {'$match': {'$and': [{'$expr': {'$eq': ['$_id', '$$job_id']}}, query]}},
+            {'$project': {'_id': True}},
+        ]
+        pipeline = [
+            {'$match': {'complete': {'$ne': True}}},
+            {
+                '$lookup': {
+                    'from': 'jobs',
+                    'let': {'job_id': '$job_id'},
+                    'pipeline': job,
+                    'as': 'job',
+                }
+            },
+            {'$match': {'job': {'$ne': []}}},
+            {'$count': 'count'},
+        ]
+        results = persistence.store.hits.aggregate(pipeline)
+        return next((result['count'] for result in results), 0)
+
+    def _load(self, docs, totals):
+        self.next = (
+            encode_cursor(docs[self.limit - 1]) if len(docs) > self.limit else None
+        )
+        self.jobs = [self._summary(data) for data in docs[: self.limit]]
+        self.totals = dict(jobs=0, pages=0, outstanding=0)
+        self.totals.update(totals)
+        self.totals.pop('_id', None)
+        cost = self.job_class.page_cost * self.totals['pages']
+        self.totals['cost'] = model.DollarAmount(cost)
+
+    def _summary(self, data):
+        data['summary'].update(
+            outstanding=data['outstanding'], complete=data['complete']
+        )
+        return model.JobSummary(self.job_class, data)
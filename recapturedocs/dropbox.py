@@ -1,3 +1,4 @@
+import datetime
 import os
 
 import dropbox
@@ -13,6 +14,38 @@ def get_session(access_key='ld83qebudvbirmj'):
     return dropbox.session.DropboxSession(access_key, secret, 'app_folder')
 
 
+def request_token(key, secret):
+    return dropbox.session.OAuthToken(key, secret)
+
+
+class RequestTokens:
+    """
+    OAuth request tokens awaiting authorization by the user, shared by
+    all server processes. Tokens expire ``ttl`` seconds after they're
+    issued and are then removed from the database by a TTL index (see
+    persistence.indexes).
+    """
+
+    ttl = 60 * 60
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def put(self, token):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        self.collection.insert_one(dict(_id=token.key, secret=token.secret, issued=now))
+
+    def pop(self, key):
+        """
+        Remove and return the token for key, or None if it's unknown or
+        expired.
+        """
+        now = datetime.datetime.now(datetime.timezone.utc)
+        issued = {'$gt': now - datetime.timedelta(seconds=self.ttl)}
+        saved = self.collection.find_one_and_delete({'_id': key, 'issued': issued})
+        return saved and request_token(saved['_id'], saved['secret'])
+
+
 def get_client(sess):
     return dropbox.client.DropboxClient(sess)
 
@@ -23,6 +56,23 @@ def load_client(token_info):
     return dropbox.client.DropboxClient(sess)
 
 
+def pdf_list(client):
+    """
+    Return the display name of the client's account and the paths of
+    the PDFs in its app folder.
+    """
+    md = client.metadata('/')
+    info = client.account_info()['display_name']
+    return (
+        info,
+        [
+            item['path']
+            for item in md['contents']
+            if item['mime_type'] == 'application/pdf'
+        ],
+    )
+
+
 def test_session():
     sess = get_session()
     request_token = sess.obtain_request_token()
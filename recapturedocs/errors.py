@@ -2,3 +2,9 @@ class InsufficientFunds(Exception):
     """
     The AWS account does not have sufficient funds.
     """
+
+
+class RegistrationInProgress(Exception):
+    """
+    The HITs for the job are already being registered.
+    """
@@ -1,18 +1,26 @@
+import atexit
+import concurrent.futures
 import datetime
+import functools
 import hashlib
 import io
 import itertools
 import logging
 import math
 import mimetypes
+import multiprocessing
+import operator
+import threading
+import xml.etree.ElementTree
 
 import botocore
-import jaraco.modb
+import jaraco.functools
+import pymongo
 from jaraco.itertools import first, one
 from jaraco.text import indent
 from PyPDF2 import PdfReader, PdfWriter
 
-from . import aws, errors, persistence
+from . import aws, codec, errors, pages, persistence
 
 log = logging.getLogger(__name__)
 
@@ -48,16 +56,44 @@ class ExternalQuestion:
         return self.template % vars(self)
 
 
+def parse_answers(answer_xml):
+    """
+    Parse the answers to a QuestionForm (as returned in an assignment's
+    Answer) into a dict keyed by question identifier.
+
+    >>> parse_answers(
+    ...     '<QuestionFormAnswers xmlns="http://mechanicalturk.amazonaws.com/'
+    ...     'AWSMechanicalTurkDataSchemas/2005-10-01/QuestionFormAnswers.xsd">'
+    ...     '<Answer><QuestionIdentifier>content</QuestionIdentifier>'
+    ...     '<FreeText>Lorem ipsum</FreeText></Answer></QuestionFormAnswers>'
+    ... )
+    {'content': 'Lorem ipsum'}
+    """
+    root = xml.etree.ElementTree.fromstring(answer_xml)
+    return {
+        answer.find('{*}QuestionIdentifier').text: answer.find('{*}FreeText').text
+        for answer in root.iterfind('{*}Answer')
+    }
+
+
+@codec.register
 class RetypePageHIT:
     reward_per_page = DollarAmount(1)
 
     type_params = dict(
-        title="Type a Page",
-        description="You will read a scanned page and retype its textual " "contents.",
-        keywords='typing page rekey retype'.split(),
-        reward=float(reward_per_page),
-        duration=datetime.timedelta(hours=2),
+        Title="Type a Page",
+        Description="You will read a scanned page and retype its textual contents.",
+        Keywords='typing,page,rekey,retype',
+        Reward=f'{reward_per_page:.2f}',
+        AssignmentDurationInSeconds=int(datetime.timedelta(hours=2).total_seconds()),
     )
+    "Parameters of the HIT type (as for create_hit_type)"
+
+    lifetime = datetime.timedelta(days=7)
+    "How long a HIT is available to workers"
+
+    schema = dict(server_url=codec.Field(), registration_result=codec.Field())
+    "Persistent attributes (see codec)"
 
     def __init__(self, server_url):
         self.server_url = server_url
@@ -67,25 +103,24 @@ class RetypePageHIT:
         """
         Return all HITs that match this HIT type
         """
-        conn = aws.ConnectionFactory.get_mturk_connection()
-        all_hits = conn.list_hits()
+        all_hits = get_all_hits()
         hit_type = cls.get_hit_type()
 
         def is_local_hit(h):
-            return h.HITTypeId == hit_type
+            return h['HITTypeId'] == hit_type
 
         return filter(is_local_hit, all_hits)
 
     @classmethod
-    def disable_all(cls):
+    def disable_all(cls, dry_run=False):
         """
-        Disable all hits that match this hit type
+        Disable all hits that match this hit type. Return the number
+        disabled or, if dry_run, that would be.
         """
-        local_hits = list(cls._local_hits())
-        conn = aws.ConnectionFactory.get_mturk_connection()
-        for hit in local_hits:
-            conn.disable_hit(hit.HITId)
-        return len(local_hits)
+        hit_ids = [hit['HITId'] for hit in cls._local_hits()]
+        if dry_run:
+            return len(hit_ids)
+        return aws.gateway.disable_hits(hit_ids)
 
     @classmethod
     def load_all(cls):
@@ -94,66 +129,113 @@ class RetypePageHIT:
     @classmethod
     def _from_existing(cls, res):
         hit = cls(None)
-        hit.registration_result = [res]
+        hit.registration_result = dict(HIT=res)
         return hit
 
     @classmethod
+    @jaraco.functools.once
     def get_hit_type(cls):
-        conn = aws.ConnectionFactory.get_mturk_connection()
-        result = one(conn.create_hit_type(**cls.type_params))
-        return result.HITTypeId
+        """
+        The id of the HIT type for these HITs (memoized, as the type
+        params never change within a process).
+        """
+        return aws.gateway.call('create_hit_type', **cls.type_params)['HITTypeId']
 
     def register(self):
-        conn = aws.ConnectionFactory.get_mturk_connection()
         try:
-            res = conn.create_hit(
-                question=self.get_external_question(), **self.type_params
+            res = aws.gateway.call(
+                'create_hit',
+                Question=self.get_external_question().get_as_xml(),
+                LifetimeInSeconds=int(self.lifetime.total_seconds()),
+                **self.type_params,
             )
-        except botocore.exceptions.BotoCoreError as error:
-            # todo: is this the right attribute to check?
-            if not error.error_code == 'AWS.MechanicalTurk.InsufficientFunds':
+        except botocore.exceptions.ClientError as error:
+            if not aws.is_insufficient_funds(error):
                 raise
             raise errors.InsufficientFunds() from error
         self.registration_result = res
         return res
 
+    def is_registered(self):
+        return getattr(self, 'registration_result', None) is not None
+
+    @property
+    def registered(self):
+        """
+        The HIT as registered with MTurk.
+        """
+        result = self.registration_result
+        if 'py/seq' in result:
+            # the result set returned by boto2, as decoded without boto2
+            return one(result['py/seq'])
+        return result['HIT']
+
     @property
     def id(self):
-        if len(self.registration_result) != 1:
-            return None
-        return self.registration_result[0].HITId
+        return self.registered['HITId']
 
     @property
     def status(self):
-        conn = aws.ConnectionFactory.get_mturk_connection()
-        return one(conn.get_hit(self.id)).HITStatus
+        """
+        The HIT status as last polled (see poller.HITPoller).
+        """
+        return self._state().get('status')
+
+    def _state(self):
+        return persistence.store.hits.find_one({'_id': self.id}) or {}
 
     def load_assignments(self):
-        conn = aws.ConnectionFactory.get_mturk_connection()
-        return conn.list_assignments_for_hit(self.id)
+        return one(aws.gateway.list_assignments([self.id]))
 
     def max_assignments(self):
-        res = getattr(self.registration_result[0], 'MaxAssignments', None)
-        return int(res) if res else 1
+        return int(self.registered.get('MaxAssignments', 1))
+
+    @classmethod
+    def load_states(cls, hit_ids):
+        """
+        Query MTurk for the current state of each of hit_ids, suitable
+        for recording in the hits collection.
+        """
+        return aws.gateway.each(cls.load_state, hit_ids)
+
+    @classmethod
+    def load_state(cls, hit_id):
+        """
+        Query MTurk for the current state of the HIT. If that fails
+        (such as for a HIT since deleted), the state records the error
+        instead, so one failing HIT doesn't hold up the others.
+        """
+        try:
+            hit = aws.gateway.call('get_hit', HITId=hit_id)['HIT']
+            response = aws.gateway.call('list_assignments_for_hit', HITId=hit_id)
+        except (
+            botocore.exceptions.BotoCoreError,
+            botocore.exceptions.ClientError,
+        ) as error:
+            log.warning("Unable to load the state of HIT %s: %s", hit_id, error)
+            return dict(error=str(error))
+        return dict(cls._get_state(hit, response['Assignments']), error=None)
+
+    @staticmethod
+    def _get_state(hit, assignments):
+        status = hit['HITStatus']
+        complete_status = ('Submitted', 'Approved')
+        complete = bool(assignments) and all(
+            assignment['AssignmentStatus'] in complete_status
+            for assignment in assignments
+        )
+        answer = parse_answers(first(assignments)['Answer']) if complete else {}
+        return dict(status=status, complete=complete, answer=answer.get('content'))
 
     def is_complete(self):
         if not self.id:
             return False
-        assignments = self.load_assignments()
-        some_results = int(assignments.NumResults) >= 1
-        complete_status = ('Submitted', 'Approved')
-        self.assignments_cache = assignments
-        return some_results and all(
-            assignment.AssignmentStatus in complete_status for assignment in assignments
-        )
+        return self._state().get('complete', False)
 
     def get_data(self):
-        assert self.is_complete()
-        assignments = self.assignments_cache
-        assignment = first(assignments)
-        answers_set = one(assignment.answers)
-        answer = dict((answer.qid, one(answer.fields)) for answer in answers_set)
-        return answer['content']
+        state = self._state()
+        assert state.get('complete')
+        return state['answer']
 
     def matches(self, id):
         "Returns true if this HIT matches the supplied hit id"
@@ -168,6 +250,148 @@ class RetypePageHIT:
             yield indent(str(assignment))
 
 
+class IdentityMap(threading.local):
+    """
+    The jobs loaded in this thread's current unit of work (a request),
+    so each job is decoded at most once, and values derived from them
+    (see unit_memo) are computed at most once per unit.
+    """
+
+    jobs = None
+    memo = None
+
+    @property
+    def active(self):
+        return self.jobs is not None
+
+    def begin(self):
+        self.jobs = {}
+        self.memo = {}
+
+    def end(self):
+        self.jobs = self.memo = None
+
+    def forget(self, job):
+        """
+        Discard values memoized for job (because it has changed).
+        """
+        if self.active:
+            memo = self.memo.items()
+            self.memo = {key: value for key, value in memo if key[0] is not job}
+
+
+identity_map = IdentityMap()
+
+
+def unit_memo(method):
+    """
+    Memoize method for the rest of the current unit of work, if any.
+    """
+
+    @functools.wraps(method)
+    def wrapper(self, *args):
+        if not identity_map.active:
+            return method(self, *args)
+        key = self, method.__name__, args
+        if key not in identity_map.memo:
+            identity_map.memo[key] = method(self, *args)
+        return identity_map.memo[key]
+
+    return wrapper
+
+
+def _page_data(page):
+    """
+    Render a single PDF page as a standalone PDF document.
+    """
+    output = PdfWriter()
+    output.add_page(page)
+    stream = io.BytesIO()
+    output.write(stream)
+    return stream.getvalue()
+
+
+def _hashing(hash, items):
+    """
+    Update hash with each item as it passes through.
+    """
+    for item in items:
+        hash.update(item)
+        yield item
+
+
+_split_pools = {}
+"Process pools for splitting PDFs, by number of workers"
+
+_split_pools_lock = threading.Lock()
+
+
+def _split_pool(workers):
+    """
+    The process pool for splitting PDFs with workers processes, shared
+    by all splits in this process. The processes are started by a fork
+    server (or spawned), rather than forked from this multi-threaded
+    process, which could deadlock them.
+    """
+    with _split_pools_lock:
+        if workers not in _split_pools:
+            methods = multiprocessing.get_all_start_methods()
+            method = 'forkserver' if 'forkserver' in methods else 'spawn'
+            context = multiprocessing.get_context(method)
+            if not _split_pools:
+                atexit.register(_shutdown_split_pools)
+            _split_pools[workers] = concurrent.futures.ProcessPoolExecutor(
+                workers, mp_context=context
+            )
+        return _split_pools[workers]
+
+
+def _shutdown_split_pools():
+    with _split_pools_lock:
+        for pool in _split_pools.values():
+            pool.shutdown()
+        _split_pools.clear()
+
+
+def _split_range(source, start, stop):
+    """
+    Split pages [start, stop) from the PDF in source (bytes). Run in a
+    worker process by ConversionJob.split_pdf.
+    """
+    input = PdfReader(io.BytesIO(source))
+    return [_page_data(input.pages[index]) for index in range(start, stop)]
+
+
+def _page_refs(data):
+    """
+    The page refs in an encoded job (none if its pages are embedded).
+
+    >>> _page_refs(dict(pages=dict(refs=['a'])))
+    ['a']
+    >>> _page_refs(dict(pages=dict(content=[b'page'])))
+    []
+
+    Jobs saved by the jsonpickle encoder are also supported.
+
+    >>> state = {'py/object': 'recapturedocs.pages.PageList', 'py/state': {'refs': ['a']}}
+    >>> _page_refs(dict(pages=state))
+    ['a']
+    >>> _page_refs(dict(pages=[b'page']))
+    []
+    """
+    state = data.get('pages')
+    if isinstance(state, dict) and 'py/state' in state:
+        state = state['py/state']
+    if isinstance(state, dict):
+        return state.get('refs', [])
+    return []
+
+
+_page_ref_fields = 'pages.refs', 'pages.py/state.refs'
+"Fields of the page refs in saved jobs (see _page_refs)"
+
+
+@codec.register
 class ConversionJob:
     """
     Conversion Job, a collection of pages to be retyped
@@ -177,8 +401,38 @@ class ConversionJob:
     page_cost = DollarAmount(1.95)
     "Price per page charged to the customer"
 
-    def __init__(self, stream, content_type, server_url, filename=None):
+    split_workers = 0
+    "Number of processes used to split a PDF (0 to always split serially)"
+
+    split_parallel_threshold = 50
+    "Documents with fewer pages than this are split serially"
+
+    spool_pages = True
+    """
+    Stream split pages into a temporary file as they are produced rather
+    than keeping them all in memory.
+    """
+
+    summary_sources = dict(page_count='pages', hit_ids='hits')
+    "Attributes from which summary fields not named for one derive"
+
+    schema = dict(
+        created=codec.Field(),
+        upload_hash=codec.Field(),
+        content_type=codec.Field(),
+        filename=codec.Field(),
+        server_url=codec.Field(),
+        authorized=codec.Field(),
+        pages=codec.Pages(),
+        _hash=codec.Field(),
+    )
+    "Persistent attributes (see codec)"
+
+    def __init__(
+        self, stream, content_type, server_url, filename=None, upload_hash=None
+    ):
         self.created = datetime.datetime.now()
+        self.upload_hash = upload_hash or self.hash_upload(stream)
         self.stream = stream
         self.content_type = content_type
         self.filename = filename
@@ -187,15 +441,37 @@ class ConversionJob:
         self.authorized = False
 
     @property
+    def pages(self):
+        return vars(self)['pages']
+
+    @pages.setter
+    def pages(self, pages):
+        vars(self)['pages'] = pages
+        # invalidate the cached id
+        vars(self).pop('_hash', None)
+
+    @property
+    @unit_memo
     def cost(self):
         return DollarAmount(self.page_cost * len(self))
 
     def do_split_pdf(self):
         msg = "Only PDF content is supported (got {content_type} instead)"
         assert self.content_type == 'application/pdf', msg.format(**vars(self))
-        self.pages = self.split_pdf(self.stream)
+        hash = hashlib.md5()
+        self.pages = self._collect_pages(_hashing(hash, self.iter_pages(self.stream)))
+        self._hash = hash.hexdigest()
         del self.stream
 
+    def _collect_pages(self, pages_):
+        """
+        Store pages as they are produced, in the page store if one is
+        configured, otherwise locally.
+        """
+        if pages.store is not None:
+            return pages.PageList.from_pages(pages_, pages.store)
+        return pages.PageSpool(pages_) if self.spool_pages else list(pages_)
+
     @classmethod
     def _from_file(cls_, filename):
         content_type, encoding = mimetypes.guess_type(filename)
@@ -204,67 +480,309 @@ class ConversionJob:
     @property
     def id(self):
         """
-        Compute the id of this job as the hash of the content.
+        The id of this job, the hash of the content of its pages. It's
+        computed as the pages are split and cached until they change.
+        """
+        if '_hash' not in vars(self):
+            hash = hashlib.md5()
+            list(map(hash.update, self.pages))
+            self._hash = hash.hexdigest()
+        return self._hash
+
+    @staticmethod
+    def hash_upload(stream, chunk_size=2**16):
+        """
+        Hash the raw content of an uploaded file and rewind it.
         """
         hash = hashlib.md5()
-        list(map(hash.update, self.pages))
+        for chunk in iter(functools.partial(stream.read, chunk_size), b''):
+            hash.update(chunk)
+        stream.seek(0)
         return hash.hexdigest()
 
     @staticmethod
-    def split_pdf(source_stream):
+    def id_for_upload(upload_hash):
+        """
+        Return the id of the job created from an upload with the given
+        hash, if any.
+        """
+        doc = persistence.store.uploads.find_one({'_id': upload_hash})
+        return doc and doc['job_id']
+
+    @classmethod
+    def split_pdf(cls, source_stream, workers=None):
+        """
+        Split the PDF in source_stream into a list of single-page PDFs.
+
+        If workers (default ``split_workers``) is greater than one and the
+        document has at least ``split_parallel_threshold`` pages, the
+        pages are sharded into contiguous ranges and split in a process
+        pool. The result is the same as for the serial split.
+        """
+        return list(cls.iter_pages(source_stream, workers))
+
+    @classmethod
+    def iter_pages(cls, source_stream, workers=None):
+        """
+        Like split_pdf, but yield each page as soon as it has been split,
+        so a serial split holds only one page in memory at a time.
+        """
+        workers = cls.split_workers if workers is None else workers
         input = PdfReader(source_stream)
+        n_pages = len(input.pages)
+        if workers <= 1 or n_pages < cls.split_parallel_threshold:
+            yield from map(_page_data, input.pages)
+            return
+        source_stream.seek(0)
+        yield from cls._split_parallel(source_stream.read(), n_pages, workers)
 
-        def get_page_data(page):
-            output = PdfWriter()
-            output.add_page(page)
-            stream = io.BytesIO()
-            output.write(stream)
-            return stream.getvalue()
+    @staticmethod
+    def _split_parallel(source, n_pages, workers):
+        shard_size = math.ceil(n_pages / workers)
+        starts = range(0, n_pages, shard_size)
+        stops = [min(start + shard_size, n_pages) for start in starts]
+        split = functools.partial(_split_range, source)
+        pool = _split_pool(workers)
+        try:
+            for shard in pool.map(split, starts, stops):
+                yield from shard
+        except concurrent.futures.BrokenExecutor:
+            # a worker died; start a new pool for the next split
+            _split_pools.pop(workers, None)
+            raise
 
-        return list(map(get_page_data, input.pages))
+    @classmethod
+    def configure(cls, config):
+        """
+        Apply the [conversion] config: split_workers and
+        split_parallel_threshold.
+        """
+        for key in ('split_workers', 'split_parallel_threshold'):
+            if key in config:
+                setattr(cls, key, config[key])
 
     def __len__(self):
         return len(self.pages)
 
     def matches(self, other):
-        return self.pages == other.pages
+        return len(self) == len(other) and all(
+            itertools.starmap(operator.eq, zip(self.pages, other.pages))
+        )
 
     def save_if_new(self):
         """
         Only save the job if there isn't already a job with the same hash
+        (checked atomically by the insert). Return True if saved.
         """
-        query = dict(_id=self.id)
-        persistence.store.jobs.find(query).count() or self.save()
+        identity_map.forget(self)
+        try:
+            persistence.store.jobs.insert_one(self._document())
+            saved = True
+        except pymongo.errors.DuplicateKeyError:
+            saved = False
+        self._save_upload()
+        return saved
 
     def save(self):
-        data = jaraco.modb.encode(self)
+        """
+        Save the whole job, replacing any saved version. Prefer update
+        to save changes to particular attributes.
+        """
+        identity_map.forget(self)
+        data = self._document()
+        persistence.store.jobs.replace_one({'_id': data['_id']}, data, upsert=True)
+        self._save_upload()
+
+    def update(self, *names):
+        """
+        Save only the named attributes, and the summary fields derived
+        from them. A job not yet saved, or saved in the legacy encoding
+        (see codec), is saved in full.
+        """
+        identity_map.forget(self)
+        values = codec.encode_fields(self, names)
+        summary = self._summary()
+        values.update(
+            (f'summary.{key}', value)
+            for key, value in summary.items()
+            if self.summary_sources.get(key, key) in names
+        )
+        query = {'_id': self.id, '_type': {'$exists': True}}
+        result = persistence.store.jobs.update_one(query, {'$set': values})
+        if not result.matched_count:
+            self.save()
+
+    def _document(self):
+        # compute the id (if not cached) while the pages are at hand
+        id = self.id
+        if pages.store is not None and not isinstance(self.pages, pages.PageList):
+            # move page content out of the job document; as the content
+            # is unchanged, so is the id
+            vars(self)['pages'] = self._collect_pages(self.pages)
+        data = codec.encode(self)
         # log.debug("saving {0!r}".format(data))
-        data['_id'] = self.id
-        self._id = persistence.store.jobs.save(data, safe=True)
+        data['_id'] = id
+        data['summary'] = self._summary()
+        return data
+
+    def _summary(self):
+        """
+        Plain fields saved alongside the encoded job, so listings can
+        load them with a projection (see JobSummary).
+        """
+        return dict(
+            filename=self.filename,
+            content_type=self.content_type,
+            created=self.created,
+            authorized=self.authorized,
+            page_count=len(self),
+        )
+
+    def _save_upload(self):
+        if not getattr(self, 'upload_hash', None):
+            return
+        persistence.store.uploads.update_one(
+            {'_id': self.upload_hash}, {'$set': {'job_id': self.id}}, upsert=True
+        )
 
     def remove(self):
         assert self.id is not None
-        persistence.store.jobs.remove(self.id)
+        self.remove_many(ids=[self.id])
+
+    @classmethod
+    def remove_many(cls, ids=None, query=None, dry_run=False):
+        """
+        Remove the jobs with the given ids and/or matching query (all
+        jobs if neither is given), together with their upload and HIT
+        index entries and any pages no remaining job shares. Return
+        the number of jobs removed or, if dry_run, that would be.
+        """
+        query = dict(query or {})
+        if ids is not None:
+            query['_id'] = {'$in': list(ids)}
+        jobs = persistence.store.jobs
+        if dry_run:
+            return jobs.count_documents(query)
+        # only the page refs, not embedded page content
+        found = list(jobs.find(query, dict.fromkeys(_page_ref_fields, True)))
+        selected = {'$in': [data['_id'] for data in found]}
+        removed = jobs.delete_many({'_id': selected}).deleted_count
+        persistence.store.uploads.delete_many({'job_id': selected})
+        persistence.store.hits.delete_many({'job_id': selected})
+        cls._remove_pages(set(itertools.chain.from_iterable(map(_page_refs, found))))
+        return removed
+
+    @staticmethod
+    def _remove_pages(refs):
+        """
+        Remove from the page store those of refs no job references,
+        except those stored recently, which a job yet to be saved may
+        reference.
+        """
+        if not refs or pages.store is None:
+            return
+        shared = set()
+        for field in _page_ref_fields:
+            query = {field: {'$in': list(refs)}}
+            shared.update(persistence.store.jobs.distinct(field, query))
+        for ref in refs.difference(shared):
+            pages.store.collect(ref)
 
     @classmethod
     def load(cls, id):
+        if identity_map.active and id in identity_map.jobs:
+            return identity_map.jobs[id]
         data = persistence.store.jobs.find_one({'_id': id})
-        return cls._restore(data) if data else None
+        job = cls._restore(data) if data else None
+        if identity_map.active:
+            identity_map.jobs[id] = job
+        return job
 
     @classmethod
     def load_all(cls):
         return (cls._restore(data) for data in persistence.store.jobs.find())
 
+    @classmethod
+    def load_summaries(cls):
+        """
+        Load a JobSummary of each job, fetching only the summary fields.
+        """
+        cursor = persistence.store.jobs.find({}, {'summary': True})
+        return (JobSummary(cls, data) for data in cursor)
+
+    @classmethod
+    def migrate_pages(cls):
+        """
+        Re-save jobs saved by the jsonpickle encoder (see codec) or
+        with their page content embedded, moving their pages into the
+        page store and recording their summary. Return the number of
+        jobs migrated.
+        """
+        query = {
+            '$or': [
+                {'_type': {'$exists': False}},
+                {'pages.content': {'$exists': True}},
+            ]
+        }
+        legacy = persistence.store.jobs.find(query, {'_id': True})
+        legacy_ids = [doc['_id'] for doc in legacy]
+        for id in legacy_ids:
+            cls.load(id).save()
+        return len(legacy_ids)
+
     @classmethod
     def _restore(cls, data):
         id = data.pop('_id')
-        result = jaraco.modb.decode(data)
+        data.pop('summary', None)
+        result = codec.decode(data)
         if not result.id == id:
             raise ValueError(f"ID mutated on load: {id} became {result.id}")
         return result
 
 
+class JobSummary:
+    """
+    A job as loaded by load_summaries: the summary fields saved with the
+    job (see ConversionJob._summary) are read directly, and the full job
+    is loaded only when any other attribute is accessed. Jobs saved
+    before summaries were recorded are loaded in full.
+    """
+
+    def __init__(self, job_class, data):
+        self.job_class = job_class
+        self.id = data['_id']
+        self.summary = data.get('summary', {})
+
+    @functools.cached_property
+    def job(self):
+        return self.job_class.load(self.id)
+
+    def __getattr__(self, name):
+        if name == 'summary':
+            raise AttributeError(name)
+        if name in self.summary:
+            return self.summary[name]
+        return getattr(self.job, name)
+
+    def __len__(self):
+        if 'page_count' in self.summary:
+            return self.summary['page_count']
+        return len(self.job)
+
+    @property
+    def hit_ids(self):
+        if 'hit_ids' in self.summary:
+            return list(filter(None, self.summary['hit_ids']))
+        return self.job.hit_ids
+
+
+@codec.register
 class MTurkConversionJob(ConversionJob):
+    register_workers = 8
+    "Number of HITs registered concurrently"
+
+    schema = dict(ConversionJob.schema, hits=codec.Objects())
+
     def register_hits(self):
         """
         Create a hit for each page in the job.
@@ -272,41 +790,217 @@ class MTurkConversionJob(ConversionJob):
         The mapping of HIT to page is implicit - they're kept arranged
         in order so that zip(self.pages, self.hits) always produces
         pairs of each page with its HIT.
+
+        HITs are registered concurrently and each is saved as soon as
+        it's registered. If registration fails, the first error is
+        raised once the other registrations finish, and calling again
+        registers only the HITs still missing.
+
+        Raise errors.RegistrationInProgress if the HITs are already
+        being registered (see claim_registration).
         """
-        self.hits = [RetypePageHIT(self.server_url) for page in self.pages]
-        for hit in self.hits:
-            hit.register()
-        assert all(hit.registration_result.status is True for hit in self.hits)
+        self.claim_registration()
+        try:
+            self._register_pending()
+        finally:
+            self.release_registration()
+
+    def claim_registration(self):
+        """
+        Claim the registration of the job's HITs, so no other request
+        or process registers them at the same time (which would create
+        duplicate HITs), and reload the HITs registered by any earlier
+        registration. Raise errors.RegistrationInProgress if the
+        registration is already claimed. Claims not released (by a
+        process that died) expire (see persistence.indexes).
+        """
+        now = datetime.datetime.now(datetime.timezone.utc)
+        try:
+            persistence.store.registrations.insert_one(dict(_id=self.id, claimed=now))
+        except pymongo.errors.DuplicateKeyError:
+            raise errors.RegistrationInProgress() from None
+        self._reload_hits()
+
+    def release_registration(self):
+        persistence.store.registrations.delete_one({'_id': self.id})
+
+    def _reload_hits(self):
+        query = {'_id': self.id, '_type': {'$exists': True}}
+        data = persistence.store.jobs.find_one(query, {'hits': True})
+        if data and 'hits' in data:
+            self.hits = self.schema['hits'].decode(data['hits'])
+
+    def _register_pending(self):
+        if not hasattr(self, 'hits'):
+            self.hits = [RetypePageHIT(self.server_url) for _ in range(len(self))]
+        self.update('hits')
+        pending = [
+            (index, hit)
+            for index, hit in enumerate(self.hits)
+            if not hit.is_registered()
+        ]
+        reserved = RetypePageHIT.reward_per_page * len(pending)
+        pool = concurrent.futures.ThreadPoolExecutor(self.register_workers)
+        with aws.balance.reserve(self.id, reserved), pool:
+            futures = [pool.submit(self._register_hit, *item) for item in pending]
+        failures = filter(None, (future.exception() for future in futures))
+        failure = next(failures, None)
+        if failure:
+            raise failure
+        assert all(hit.is_registered() for hit in self.hits)
+
+    def _register_hit(self, index, hit):
+        hit.register()
+        update = {
+            '$set': {
+                f'hits.{index}': codec.encode(hit),
+                f'summary.hit_ids.{index}': hit.id,
+            }
+        }
+        persistence.store.jobs.update_one({'_id': self.id}, update)
+        persistence.store.hits.bulk_write([self._index_request(index, hit)])
+
+    def _summary(self):
+        summary = super()._summary()
+        hits = getattr(self, 'hits', [])
+        summary['hit_ids'] = [hit.id if hit.is_registered() else None for hit in hits]
+        return summary
 
     @property
+    def hit_ids(self):
+        """
+        The ids of the HITs registered so far.
+        """
+        return [hit.id for hit in getattr(self, 'hits', []) if hit.is_registered()]
+
+    def register_hits_async(self, on_error=None):
+        """
+        Register the HITs in a background thread, returning immediately.
+        Progress is reported by registered_count. If registration fails,
+        call on_error with the exception. The registration is claimed
+        before returning, so errors.RegistrationInProgress is raised
+        to the caller.
+        """
+        self.claim_registration()
+
+        def register():
+            try:
+                self._register_pending()
+            except Exception as error:
+                log.exception("Error registering HITs for %s", self.id)
+                if on_error:
+                    on_error(error)
+            finally:
+                self.release_registration()
+
+        threading.Thread(target=register, name=f'register-{self.id}').start()
+
+    @unit_memo
+    def registered_count(self):
+        """
+        The number of HITs registered so far.
+        """
+        return persistence.store.hits.count_documents({'job_id': self.id})
+
+    def index_hits(self):
+        """
+        Record the job, page index and page reference for each HIT in
+        the hits collection, so the page for a HIT can be found without
+        loading the job.
+        """
+        requests = [
+            self._index_request(index, hit)
+            for index, hit in enumerate(self.hits)
+            if hit.is_registered()
+        ]
+        if requests:
+            persistence.store.hits.bulk_write(requests, ordered=False)
+
+    def _index_request(self, index, hit):
+        refs = getattr(self.pages, 'refs', None)
+        return pymongo.UpdateOne(
+            {'_id': hit.id},
+            {
+                '$set': dict(
+                    job_id=self.id,
+                    page=index,
+                    page_ref=refs[index] if refs else None,
+                    content_type=self.content_type,
+                )
+            },
+            upsert=True,
+        )
+
+    @property
+    @unit_memo
     def can_authorize(self):
         """
         A job cannot be authorized if the balance in the Mechanical Turk
         account is not sufficient to service the job.
         """
-        conn = aws.ConnectionFactory.get_mturk_connection()
-        balance = conn.get_account_balance()[0].amount
-        return RetypePageHIT.reward_per_page * len(self) <= balance
+        return self.reward <= aws.balance.available()
 
+    @property
+    def reward(self):
+        """
+        The total reward paid to workers for this job.
+        """
+        return RetypePageHIT.reward_per_page * len(self)
+
+    @unit_memo
     def is_complete(self):
-        return all(hit.is_complete() for hit in self.hits)
+        """
+        Are all of the HITs complete (as last polled)?
+        """
+        query = {'job_id': self.id, 'complete': True}
+        return persistence.store.hits.count_documents(query) == len(self.hits)
 
     def get_data(self):
-        return '\n\n\n'.join(hit.get_data() for hit in self.hits if hit.is_complete())
+        query = {'job_id': self.id, 'complete': True}
+        states = persistence.store.hits.find(query, {'answer': True}).sort('page')
+        return '\n\n\n'.join(state['answer'] for state in states)
 
     def get_hit(self, hit_id):
         return next(hit for hit in self.hits if hit.id == hit_id)
 
     def page_for_hit(self, hit_id):
-        pages = dict((hit.id, page) for hit, page in zip(self.hits, self.pages))
-        return pages[hit_id]
+        hit_ids = [hit.id for hit in self.hits]
+        return self.pages[hit_ids.index(hit_id)]
 
     @classmethod
     def for_hitid(cls, hit_id):
-        # the hitID is stored in the database here
-        hitid_loc = 'hits.registration_result.py/seq.HITId'
-        data = persistence.store.jobs.find_one({hitid_loc: hit_id})
-        return cls._restore(data)
+        entry = cls.locate_hit(hit_id)
+        return entry and cls.load(entry['job_id'])
+
+    @classmethod
+    def locate_hit(cls, hit_id):
+        """
+        Return the hits index entry for hit_id or None if there's no
+        such HIT. Jobs whose HITs were registered before the index
+        existed are indexed by index_all_hits.
+        """
+        return persistence.store.hits.find_one({'_id': hit_id})
+
+    @classmethod
+    def index_all_hits(cls):
+        """
+        Record the HITs of every job with HITs in the hits index (see
+        index_hits). Return the number of jobs indexed.
+        """
+        query = {'hits.0': {'$exists': True}}
+        ids = [doc['_id'] for doc in persistence.store.jobs.find(query, {'_id': True})]
+        for id in ids:
+            cls.load(id).index_hits()
+        return len(ids)
+
+    @classmethod
+    def load_page(cls, entry):
+        """
+        Load the page referenced by a hits index entry.
+        """
+        if entry['page_ref'] is None:
+            return cls.load(entry['job_id']).pages[entry['page']]
+        return pages.store.get(entry['page_ref'])
 
     def dump_pages(self):
         for hit, page in zip(self.hits, self.pages):
@@ -323,25 +1017,9 @@ class MTurkConversionJob(ConversionJob):
         return '\n'.join(self._report())
 
 
-def get_all_hits(conn):
-    page_size = 100
-    search_rs = conn.search_hits(page_size=page_size)
-    total_records = int(search_rs.TotalNumResults)
-
-    def get_page_hits(page):
-        search_rs = conn.search_hits(page_size=page_size, page_number=page)
-        if not search_rs.status:
-            raise Exception(
-                f'Error performing search, code:{search_rs.Code}, '
-                'message:{search_rs.Message}'
-            )
-        return search_rs
-
-    def get_page_numbers(page_size, total_records):
-        # TODO, is this zero-based or 1-based? If it's zero, based, change
-        #  start to 0.
-        limit = math.ceil(total_records / page_size)
-        return itertools.islice(itertools.count(start=1), limit)
-
-    hit_sets = map(get_page_hits, get_page_numbers(page_size, total_records))
-    return list(itertools.chain.from_iterable(hit_sets))
+def get_all_hits(gateway=aws.gateway):
+    """
+    Lazily yield all HITs, fetching the next page of results in the
+    background.
+    """
+    return gateway.paginate('list_hits', 'HITs', prefetch=True, MaxResults=100)
@@ -0,0 +1,295 @@
+"""
+Storage for the single-page PDFs that make up a conversion job.
+"""
+
+import collections.abc
+import contextlib
+import datetime
+import hashlib
+import io
+import os
+import pathlib
+import shutil
+import tempfile
+import threading
+
+import bson
+import gridfs
+
+store = None
+"The PageStore for this process, set by init()"
+
+
+def init(db):
+    globals().update(store=PageStore(db))
+
+
+def page_ref(data):
+    """
+    Return the content address of a page.
+
+    >>> page_ref(b'page')[:16]
+    '3660315a9af3df25'
+    """
+    return hashlib.sha256(data).hexdigest()
+
+
+class PageSpool(collections.abc.Sequence):
+    """
+    An append-only sequence of pages spooled to a temporary file, so
+    that only the page currently being read is held in memory.
+
+    >>> spool = PageSpool([b'first', b'second'])
+    >>> spool.append(b'third')
+    >>> len(spool)
+    3
+    >>> spool[1]
+    b'second'
+    >>> spool[-1]
+    b'third'
+    >>> list(spool) == [b'first', b'second', b'third']
+    True
+
+    When serialized, a spool saves its pages, which are spooled again
+    on restore.
+
+    >>> import pickle
+    >>> restored = pickle.loads(pickle.dumps(spool))
+    >>> restored[:2]
+    [b'first', b'second']
+    """
+
+    def __init__(self, pages=()):
+        self.file = tempfile.TemporaryFile()
+        self.extents = []
+        self.lock = threading.Lock()
+        self.extend(pages)
+
+    def extend(self, pages):
+        for page in pages:
+            self.append(page)
+
+    def append(self, data):
+        with self.lock:
+            offset = self.file.seek(0, io.SEEK_END)
+            self.file.write(data)
+        self.extents.append((offset, len(data)))
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[item] for item in range(*index.indices(len(self)))]
+        offset, size = self.extents[index]
+        with self.lock:
+            self.file.seek(offset)
+            return self.file.read(size)
+
+    def __len__(self):
+        return len(self.extents)
+
+    def __getstate__(self):
+        return list(self)
+
+    def __setstate__(self, state):
+        self.__init__(state)
+
+    def __del__(self):
+        self.file.close()
+
+
+class PageStore:
+    """
+    Content-addressed storage of pages in GridFS. Each page is stored
+    once, keyed by its page_ref, however many jobs include it.
+
+    Each put records when the page was (last) stored, so a page
+    another job is about to reference isn't collected before that
+    job is saved (see collect).
+    """
+
+    grace = datetime.timedelta(hours=1)
+    "How long after it's stored a page is kept, referenced or not"
+
+    def __init__(self, db, collection='pages'):
+        self.fs = gridfs.GridFS(db, collection=collection)
+        self.files = db[f'{collection}.files']
+        self.chunks = db[f'{collection}.chunks']
+
+    def put(self, data):
+        ref = page_ref(data)
+        stored = datetime.datetime.now(datetime.timezone.utc)
+        touched = self.files.update_one({'_id': ref}, {'$set': {'stored': stored}})
+        if touched.matched_count:
+            return ref
+        try:
+            self.fs.put(data, _id=ref, stored=stored)
+        except gridfs.errors.FileExists:
+            # stored concurrently by another request
+            pass
+        return ref
+
+    def open(self, ref):
+        """
+        Return a file-like object for reading the page.
+        """
+        return self.fs.get(ref)
+
+    def get(self, ref):
+        with self.open(ref) as file:
+            return file.read()
+
+    def collect(self, ref):
+        """
+        Delete the page unless it was stored within the grace period.
+        Pages stored before puts were recorded have no stored date and
+        are deleted.
+
+        Only chunks written before the cutoff are deleted, so a put that
+        stores the page again once its file is deleted keeps its chunks.
+        """
+        cutoff = datetime.datetime.now(datetime.timezone.utc) - self.grace
+        query = {'_id': ref, 'stored': {'$not': {'$gte': cutoff}}}
+        if self.files.delete_one(query).deleted_count:
+            written = {'$lt': bson.ObjectId.from_datetime(cutoff)}
+            self.chunks.delete_many({'files_id': ref, '_id': written})
+
+
+class PageList(collections.abc.Sequence):
+    """
+    The ordered pages of a job, held as references into a PageStore
+    and fetched only when accessed. Only the references are serialized.
+    """
+
+    def __init__(self, refs, store=None):
+        self.refs = list(refs)
+        self._store = store
+
+    @classmethod
+    def from_pages(cls, pages, store):
+        """
+        Put each page in the store as it is produced.
+        """
+        return cls(map(store.put, pages), store)
+
+    @property
+    def store(self):
+        return store if self._store is None else self._store
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.store.get(ref) for ref in self.refs[index]]
+        return self.store.get(self.refs[index])
+
+    def __len__(self):
+        return len(self.refs)
+
+    def __getstate__(self):
+        return dict(refs=self.refs)
+
+    def __setstate__(self, state):
+        self.__init__(state['refs'])
+
+
+class PageFiles:
+    """
+    A size-bounded, content-addressed directory of page files, filled
+    from a page store on demand, so a front end (nginx) can serve pages
+    directly from disk. The directory must be readable by the user the
+    front end runs as (www-data for nginx); the files are made readable
+    by all users.
+
+    >>> root = getfixture('tmp_path')
+    >>> files = PageFiles(root, max_size=10)
+    >>> path = files.materialize('abc', lambda: io.BytesIO(b'123456'))
+    >>> path.read_bytes()
+    b'123456'
+    >>> files.relative(path)
+    'ab/abc'
+    >>> oct(path.stat().st_mode & 0o777)
+    '0o644'
+
+    Present files are not reloaded.
+
+    >>> files.materialize('abc', None) == path
+    True
+
+    When the files exceed max_size, the least-recently used are removed.
+
+    >>> _ = files.materialize('def', lambda: io.BytesIO(b'123456'))
+    >>> path.exists()
+    False
+    """
+
+    def __init__(self, root, max_size):
+        self.root = pathlib.Path(root)
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.total = sum(entry.stat().st_size for entry in self._entries())
+
+    def path(self, ref):
+        return self.root / ref[:2] / ref
+
+    def relative(self, path):
+        return path.relative_to(self.root).as_posix()
+
+    def materialize(self, ref, open_source):
+        """
+        Return the path to the file for ref, first copying it from the
+        file-like object returned by open_source if it's not present.
+        """
+        path = self.path(ref)
+        try:
+            # mark as recently used
+            os.utime(path)
+            return path
+        except FileNotFoundError:
+            pass
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = tempfile.NamedTemporaryFile(dir=path.parent, prefix='.', delete=False)
+        try:
+            with tmp, open_source() as source:
+                shutil.copyfileobj(source, tmp)
+            # temporary files are private; the front end must read it
+            os.chmod(tmp.name, 0o644)
+            size = os.stat(tmp.name).st_size
+            os.replace(tmp.name, path)
+        except BaseException:
+            # not evicted, as it's named as a temporary file
+            os.remove(tmp.name)
+            raise
+        with self.lock:
+            self.total += size
+            if self.total > self.max_size:
+                self._evict(keep=path)
+        return path
+
+    def _entries(self):
+        """
+        Page files (excluding temporary files being written).
+        """
+        return (
+            entry
+            for dir in os.scandir(self.root)
+            if dir.is_dir()
+            for entry in os.scandir(dir.path)
+            if not entry.name.startswith('.')
+        )
+
+    def _evict(self, keep):
+        """
+        Remove the least-recently used files until the total is within
+        max_size. Rescans the directory, as other processes may share it.
+        """
+        entries = sorted(
+            (entry.stat().st_mtime, entry.stat().st_size, entry.path)
+            for entry in self._entries()
+        )
+        self.total = sum(size for mtime, size, path in entries)
+        for mtime, size, path in entries:
+            if self.total <= self.max_size:
+                break
+            if path == str(keep):
+                continue
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+            self.total -= size
@@ -1,18 +1,128 @@
+import functools
+import logging
+
 import cherrypy
+import pymongo
 from jaraco.mongodb import helper
 
-from . import jsonpickle
+from . import aws, dropbox, jsonpickle, pages, uploads
+
+log = logging.getLogger(__name__)
+
+indexes = {
+    'jobs': [
+        # dashboard listing, newest first (see dashboard.Dashboard)
+        pymongo.IndexModel([('summary.created', -1), ('_id', -1)], name='created'),
+        pymongo.IndexModel(
+            [('summary.authorized', 1), ('summary.created', -1)],
+            name='authorized_created',
+        ),
+        # pages still referenced when removing jobs
+        pymongo.IndexModel('pages.refs', name='page_refs'),
+    ],
+    'hits': [
+        pymongo.IndexModel([('job_id', 1), ('page', 1)], name='job_page'),
+        # outstanding HITs, least recently checked first (see poller)
+        pymongo.IndexModel([('complete', 1), ('checked', 1)], name='outstanding'),
+    ],
+    'uploads': [
+        pymongo.IndexModel('job_id', name='job'),
+    ],
+    'dropbox.request_tokens': [
+        pymongo.IndexModel(
+            'issued', expireAfterSeconds=dropbox.RequestTokens.ttl, name='expiry'
+        ),
+    ],
+    'registrations': [
+        # claims on registering a job's HITs, released when done or,
+        # by a process that died, expired (see model.MTurkConversionJob)
+        pymongo.IndexModel('claimed', expireAfterSeconds=60 * 60, name='expiry'),
+    ],
+    'balance_reservations': [
+        pymongo.IndexModel(
+            'reserved', expireAfterSeconds=aws.SharedReservations.ttl, name='expiry'
+        ),
+    ],
+    'upload_queue': [
+        # pending uploads, next available first (see uploads.UploadQueue)
+        pymongo.IndexModel([('status', 1), ('available', 1)], name='available'),
+    ],
+}
+"Indexes on each collection, ensured by init_mongodb"
+
+client_options = {
+    'pool.max_size': 'maxPoolSize',
+    'pool.min_size': 'minPoolSize',
+    'pool.max_idle_time': 'maxIdleTimeMS',
+    'timeout.connect': 'connectTimeoutMS',
+    'timeout.socket': 'socketTimeoutMS',
+    'timeout.server_selection': 'serverSelectionTimeoutMS',
+    'timeout.wait_queue': 'waitQueueTimeoutMS',
+    'write_concern': 'w',
+    'journal': 'journal',
+    'read_preference': 'readPreference',
+}
+"MongoClient options by their keys in the [persistence] config (times in ms)"
+
+
+def get_client_options(ps):
+    """
+    Select the MongoClient options from the persistence config.
 
+    >>> get_client_options({'pool.max_size': 50, 'storage.uri': 'mongodb://'})
+    {'maxPoolSize': 50}
+    """
+    return {option: ps[key] for key, option in client_options.items() if key in ps}
 
-def init_mongodb():
+
+def init_mongodb(ensure=True):
     ps = cherrypy._whole_config.get('persistence', dict())
     storage_uri = ps.get('storage.uri', 'mongodb://localhost')
     is_production = cherrypy.config.get('server.production', False)
     s_name = 'recapturedocs' if is_production else 'recapturedocs_devel'
-    store = helper.connect_db(storage_uri, default_db_name=s_name)
+    factory = functools.partial(pymongo.MongoClient, **get_client_options(ps))
+    store = helper.connect_db(storage_uri, default_db_name=s_name, factory=factory)
     globals().update(store=store)
+    pages.init(store)
+    aws.init(store)
+    uploads.init(store)
+    if ensure and ps.get('indexes.ensure', True):
+        ensure_indexes(store)
+
+
+def ensure_indexes(db):
+    """
+    Create any missing indexes. Errors are logged rather than raised,
+    so the application can start while the database is unavailable.
+    """
+    try:
+        for name, models in indexes.items():
+            db[name].create_indexes(models)
+    except pymongo.errors.PyMongoError as error:
+        log.error("Unable to ensure indexes: %s", error)
+
+
+def index_report(db):
+    """
+    Describe indexes missing from, not declared on, or unused on each
+    collection. Usage is as counted by mongod, which resets its counts
+    when it restarts or the index is rebuilt, so an index is only
+    reported unused since then.
+    """
+    for name, models in indexes.items():
+        declared = {index.document['name'] for index in models} | {'_id_'}
+        present = set(db[name].index_information())
+        for index in sorted(declared - present):
+            yield f"Index {name}.{index} is missing"
+        for index in sorted(present - declared):
+            yield f"Index {name}.{index} is not declared"
+        usage = db[name].aggregate([{'$indexStats': {}}])
+        for stats in usage:
+            if stats['accesses']['ops'] == 0 and stats['name'] != '_id_':
+                since = stats['accesses']['since']
+                yield f"Index {name}.{stats['name']} unused since {since}"
 
 
-def init():
-    init_mongodb()
+def init(ensure_indexes=True):
+    init_mongodb(ensure=ensure_indexes)
     jsonpickle.setup_handlers()
@@ -0,0 +1,61 @@
+"""
+Background polling of Mechanical Turk for the state of HITs, so
+requests only ever read the state recorded in the hits collection.
+"""
+
+import datetime
+import logging
+
+import cherrypy
+import pymongo
+from cherrypy.process import plugins
+
+from . import model, persistence
+
+log = logging.getLogger(__name__)
+
+
+class HITPoller(plugins.Monitor):
+    """
+    A CherryPy engine plugin that, every ``frequency`` seconds, polls
+    up to ``batch_size`` of the outstanding HITs, least recently checked
+    first, through the aws.Gateway, and records each HIT's status,
+    completion and answer, or the error fetching them. Either way, the
+    HIT is marked checked, so the next poll moves on to other HITs.
+    """
+
+    def __init__(self, bus, frequency=60, batch_size=100):
+        super().__init__(bus, self.poll, frequency=frequency, name='HITPoller')
+        self.batch_size = batch_size
+
+    def outstanding(self):
+        query = {'complete': {'$ne': True}}
+        cursor = persistence.store.hits.find(query, {'_id': True})
+        cursor = cursor.sort('checked', 1).limit(self.batch_size)
+        return [doc['_id'] for doc in cursor]
+
+    def poll(self):
+        hit_ids = self.outstanding()
+        if not hit_ids:
+            return
+        try:
+            states = model.RetypePageHIT.load_states(hit_ids)
+        except Exception:
+            log.exception("Error polling %d HITs", len(hit_ids))
+            return
+        checked = datetime.datetime.now(datetime.timezone.utc)
+        requests = [
+            pymongo.UpdateOne({'_id': hit_id}, {'$set': dict(state, checked=checked)})
+            for hit_id, state in zip(hit_ids, states)
+        ]
+        persistence.store.hits.bulk_write(requests, ordered=False)
+
+
+def subscribe(config):
+    """
+    Subscribe a HITPoller to the engine unless disabled in config.
+    """
+    if not config.get('on', True):
+        return
+    params = {key: config[key] for key in ('frequency', 'batch_size') if key in config}
+    HITPoller(cherrypy.engine, **params).subscribe()
@@ -1,17 +1,19 @@
 import argparse
 import code
+import concurrent.futures
 import contextlib
 import functools
 import importlib
 import inspect
+import io
 import itertools
 import logging
+import operator
 import os
 import shlex
 import socket
 import sys
 import urllib.parse
-from typing import Dict
 
 import boto3
 import cherrypy
@@ -21,12 +23,44 @@ import genshi.template
 import jaraco.collections as dictlib
 import jaraco.logging
 import pkg_resources
+from cherrypy.lib import httputil
 from jaraco.classes import meta
 from jaraco.email import notification
 
 import recapturedocs
 
-from . import config, dropbox, errors, model, persistence
+from . import (
+    aws,
+    cache,
+    cluster,
+    config,
+    dashboard,
+    dropbox,
+    errors,
+    model,
+    pages,
+    persistence,
+    poller,
+    sync,
+    uploads,
+)
+
+
+class IdentityMapTool(cherrypy.Tool):
+    """
+    Load each job at most once per request and memoize values derived
+    from it for the rest of the request (see model.IdentityMap).
+    """
+
+    def __init__(self):
+        super().__init__('on_start_resource', model.identity_map.begin)
+
+    def _setup(self):
+        super()._setup()
+        cherrypy.request.hooks.attach('on_end_request', model.identity_map.end)
+
+
+cherrypy.tools.job_map = IdentityMapTool()
 
 
 class JobServer:
@@ -38,6 +72,15 @@ class JobServer:
         genshi.template.loader.package(__name__, 'view')
     ])
 
+    page_cache = cache.SizedLRU(max_size=64 * 2**20, size=lambda page: len(page[2]))
+    "Recently served pages by HIT id, bounded by the bytes cached"
+
+    page_max_age = 24 * 60 * 60
+    "Seconds browsers and proxies may cache a page (pages never change)"
+
+    queue_uploads = False
+    "Process uploads through the upload queue (see uploads.subscribe)"
+
     @cherrypy.expose
     def index(self):
         tmpl = self.tl.load('main.xhtml')
@@ -73,18 +116,51 @@ class JobServer:
         if content_type != 'application/pdf':
             msg = "Got content other than PDF: {content_type}"
             cherrypy.log(msg.format(**vars(file)), severity=logging.WARNING)
-        job = job_class(file.file, content_type, server_url, file.filename)
-        job.save_if_new()
-        self.send_notice(f"A new document was uploaded ({job.id})")
-        raise cherrypy.HTTPRedirect(f"status/{job.id}")
+        upload_hash = job_class.hash_upload(file.file)
+        job_id = job_class.id_for_upload(upload_hash)
+        if job_id is None and self.queue_uploads:
+            uploads.queue.put(
+                file.file,
+                content_type,
+                server_url,
+                file.filename,
+                upload_hash,
+                job_class,
+            )
+            # the status page follows the upload to its job
+            job_id = upload_hash
+        elif job_id is None:
+            job = job_class(
+                file.file, content_type, server_url, file.filename, upload_hash
+            )
+            job.save_if_new()
+            self.send_notice(f"A new document was uploaded ({job.id})")
+            job_id = job.id
+        raise cherrypy.HTTPRedirect(f"status/{job_id}")
 
     @cherrypy.expose
     def status(self, job_id):
         tmpl = self.tl.load('status.xhtml')
         job = self._get_job_for_id(job_id)
+        if job is None:
+            return self._upload_status(job_id)
         tmpl_gen = tmpl.generate(job=job, production=self.is_production())
         return tmpl_gen.render('xhtml')
 
+    def _upload_status(self, upload_hash):
+        """
+        Report on a queued upload, or redirect to the job created from
+        it.
+        """
+        job_id = model.ConversionJob.id_for_upload(upload_hash)
+        if job_id is not None:
+            raise cherrypy.HTTPRedirect(f'/status/{job_id}')
+        upload = uploads.queue and uploads.queue.get(upload_hash)
+        if upload is None:
+            raise cherrypy.NotFound()
+        tmpl = self.tl.load('pending.xhtml')
+        return tmpl.generate(upload=upload).render('xhtml')
+
     @cherrypy.expose
     def initiate_payment(self, job_id):
         """
@@ -124,7 +200,8 @@ class JobServer:
         except errors.InsufficientFunds:
             self.send_notice(f"insufficient funds registering hits for {job_id}")
             target = '/error/our fault'
-        job.save()
+        except errors.RegistrationInProgress:
+            target = f'/status/{job_id}'
         raise cherrypy.HTTPRedirect(target)
 
     @cherrypy.expose
@@ -169,12 +246,69 @@ class JobServer:
 
     @cherrypy.expose
     def image(self, hit_id):
+        if self.page_files:
+            return self._accel_page(hit_id)
+        content_type, etag, data = self._get_page(hit_id)
+        headers = cherrypy.response.headers
+        headers['ETag'] = etag
+        headers['Cache-Control'] = f'public, max-age={self.page_max_age}'
+        cherrypy.lib.cptools.validate_etags()
+        return serve_bytes(data, content_type)
+
+    @functools.cached_property
+    def page_files(self):
+        """
+        If configured (in the [page_files] section), the PageFiles
+        cache from which nginx serves pages.
+        """
+        files_config = self._app.config.get('page_files')
+        if not files_config:
+            return None
+        root = files_config.get('dir') or config.get_config_dir() / 'pages'
+        max_size = files_config.get('max_size', 2**30)
+        return pages.PageFiles(root, max_size)
+
+    def _accel_page(self, hit_id):
+        """
+        Materialize the page for hit_id on disk and have nginx send it
+        (with X-Accel-Redirect) rather than streaming it from here.
+        """
+        entry = model.MTurkConversionJob.locate_hit(hit_id)
+        if not entry:
+            raise cherrypy.NotFound
+        ref = entry['page_ref']
+        if ref:
+            open_page = functools.partial(pages.store.open, ref)
+        else:
+            data = model.MTurkConversionJob.load_page(entry)
+            ref = pages.page_ref(data)
+            open_page = functools.partial(io.BytesIO, data)
+        headers = cherrypy.response.headers
+        headers['Content-Type'] = entry['content_type']
+        headers['ETag'] = f'"{ref}"'
+        headers['Cache-Control'] = f'public, max-age={self.page_max_age}'
+        # before materializing, which a 304 doesn't need
+        cherrypy.lib.cptools.validate_etags()
+        path = self.page_files.materialize(ref, open_page)
+        location = self._app.config['page_files']['location']
+        headers['X-Accel-Redirect'] = location + self.page_files.relative(path)
+        return b''
+
+    def _get_page(self, hit_id):
+        """
+        Return the content type, ETag and content of the page for hit_id.
+        """
+        page = self.page_cache.get(hit_id)
+        if page:
+            return page
         # find the appropriate image
-        job = model.MTurkConversionJob.for_hitid(hit_id)
-        if not job:
+        entry = model.MTurkConversionJob.locate_hit(hit_id)
+        if not entry:
             raise cherrypy.NotFound
-        cherrypy.response.headers['Content-Type'] = job.content_type
-        return job.page_for_hit(hit_id)
+        data = model.MTurkConversionJob.load_page(entry)
+        etag = '"{}"'.format(entry['page_ref'] or pages.page_ref(data))
+        page = self.page_cache[hit_id] = entry['content_type'], etag, data
+        return page
 
     @cherrypy.expose
     def design(self):
@@ -194,12 +328,7 @@ class JobServer:
         return tmpl.generate(content=html).render('xhtml')
 
     def __iter__(self):
-        return model.MTurkConversionJob.load_all()
-
-    def __delitem__(self, key):
-        jobs = list(iter(self))
-        for job in jobs[key]:
-            job.remove()
+        return model.MTurkConversionJob.load_summaries()
 
     @cherrypy.expose
     def error(self, why):
@@ -213,14 +342,38 @@ class JobServer:
         return tmpl.generate(content=message).render('xhtml')
 
     def send_notice(self, msg):
-        app_config = self._app.config
-        if 'notification' not in app_config:
-            return
-        notn_config = app_config['notification']
-        addr_to = notn_config['smtp_to']
-        host = notn_config['smtp_host']
-        mb = notification.SMTPMailbox(to_addrs=addr_to, host=host)
-        mb.notify(msg)
+        send_notice(self._app.config.get('notification'), msg)
+
+
+def send_notice(notn_config, msg):
+    if notn_config is None:
+        return
+    addr_to = notn_config['smtp_to']
+    host = notn_config['smtp_host']
+    mb = notification.SMTPMailbox(to_addrs=addr_to, host=host)
+    mb.notify(msg)
+
+
+def serve_bytes(data, content_type):
+    """
+    Serve data, honoring a single-range Range request.
+    """
+    request, response = cherrypy.request, cherrypy.response
+    response.headers['Content-Type'] = content_type
+    if request.protocol < (1, 1):
+        return data
+    response.headers['Accept-Ranges'] = 'bytes'
+    ranges = httputil.get_ranges(request.headers.get('Range'), len(data))
+    if ranges == []:
+        response.headers['Content-Range'] = f'bytes */{len(data)}'
+        raise cherrypy.HTTPError(416)
+    if not ranges or len(ranges) > 1:
+        return data
+    start, stop = ranges[0]
+    stop = min(stop, len(data))
+    response.status = 206
+    response.headers['Content-Range'] = f'bytes {start}-{stop - 1}/{len(data)}'
+    return data[start:stop]
 
 
 class GGCServer:
@@ -233,7 +386,10 @@ class GGCServer:
         genshi.template.loader.package(__name__, 'view'),
     ])
 
-    tokens: Dict[str, str] = dict()
+    @staticmethod
+    def request_tokens():
+        # in the database, as the callback may reach another process
+        return dropbox.RequestTokens(persistence.store.dropbox.request_tokens)
 
     @cherrypy.expose
     def index(self):
@@ -243,7 +399,7 @@ class GGCServer:
     def authorize(self):
         sess = dropbox.get_session()
         request_token = sess.obtain_request_token()
-        self.tokens[request_token.key] = request_token
+        self.request_tokens().put(request_token)
         callback = cherrypy.url('save_token')
         url = sess.build_authorize_url(request_token, oauth_callback=callback)
         raise cherrypy.HTTPRedirect(url)
@@ -251,16 +407,14 @@ class GGCServer:
     @cherrypy.expose
     def save_token(self, oauth_token, uid, **kwargs):
         sess = dropbox.get_session()
-        access_token = sess.obtain_access_token(self.tokens[oauth_token])
-        persistence.store.dropbox.tokens.update(
-            dict(
-                _id=uid,
-            ),
-            dict(
-                _id=uid,
-                key=access_token.key,
-                secret=access_token.secret,
-            ),
+        request_token = self.request_tokens().pop(oauth_token)
+        if request_token is None:
+            raise cherrypy.HTTPError(400, "Unknown or expired request token")
+        access_token = sess.obtain_access_token(request_token)
+        # keep any sync cursor (see sync.DropboxSync)
+        persistence.store.dropbox.tokens.update_one(
+            {'_id': uid},
+            {'$set': dict(key=access_token.key, secret=access_token.secret)},
             upsert=True,
         )
         info = dropbox.get_client(sess).account_info()
@@ -270,25 +424,37 @@ class GGCServer:
         )
         return tmpl.generate(content=message).render('xhtml')
 
+    listings = cache.TTLCache(ttl=5 * 60)
+    "PDF listings by Dropbox account"
+
+    listing_timeout = 10
+    "Seconds to wait for accounts to be listed; slower ones are omitted"
+
+    listing_pool = concurrent.futures.ThreadPoolExecutor(8)
+
     @cherrypy.expose
     def list(self):
-        def pdf_list(client):
-            md = client.metadata('/')
-            info = client.account_info()['display_name']
-            return (
-                info,
-                [
-                    item['path']
-                    for item in md['contents']
-                    if item['mime_type'] == 'application/pdf'
-                ],
-            )
-
-        lists = map(
-            pdf_list, map(dropbox.load_client, persistence.store.dropbox.tokens.find())
-        )
+        tokens = persistence.store.dropbox.tokens.find()
+        futures = [self._list_account(info) for info in tokens]
+        done, pending = concurrent.futures.wait(futures, timeout=self.listing_timeout)
+        listed = [future for future in futures if future in done]
+        for future in filter(operator.methodcaller('exception'), listed):
+            cherrypy.log(f"Unable to list a Dropbox account: {future.exception()}")
+        lists = [future.result() for future in listed if not future.exception()]
         tmpl = self.tl.load('list.xhtml')
-        return tmpl.generate(lists=lists).render('xhtml')
+        missing = len(futures) - len(lists)
+        return tmpl.generate(lists=lists, missing=missing).render('xhtml')
+
+    def _list_account(self, token_info):
+        """
+        Return a future for the listing of the account, listed in the
+        listing pool unless it's cached or already being listed.
+        """
+
+        def load():
+            return dropbox.pdf_list(dropbox.load_client(token_info))
+
+        return self.listings.submit(token_info['_id'], load, self.listing_pool)
 
 
 class Admin:
@@ -301,23 +467,59 @@ class Admin:
         self.server = server
 
     @cherrypy.expose
-    def status(self):
+    def status(self, authorized='', complete='', since='', until='', after=None):
+        """
+        List the jobs a page at a time, newest first, optionally
+        filtered by authorization, completion and date created
+        (since and until are inclusive dates, YYYY-MM-DD).
+        """
+        filters = dict(
+            authorized=authorized, complete=complete, since=since, until=until
+        )
+        try:
+            query = dashboard.job_filter(
+                authorized=dashboard.parse_flag(authorized),
+                since=dashboard.parse_date(since),
+                until=dashboard.parse_date(until, days=1),
+            )
+            board = dashboard.Dashboard(
+                query, complete=dashboard.parse_flag(complete), after=after
+            )
+        except ValueError as error:
+            raise cherrypy.HTTPError(400, str(error))
+        next_url = board.next and 'status?' + urllib.parse.urlencode(
+            dict(filters, after=board.next)
+        )
         tmpl = self.tl.load('status.xhtml')
-        return tmpl.generate(jobs=list(self.server)).render('xhtml')
+        return tmpl.generate(
+            jobs=board.jobs, totals=board.totals, filters=filters, next_url=next_url
+        ).render('xhtml')
 
     @cherrypy.expose
-    def disable_all(self):
+    def disable_all(self, dry_run=''):
         """
         Disable of all recapture-docs hits (even those not recognized by this
-        server).
+        server) and remove all jobs. With dry_run, only report how many
+        would be.
         """
-        disabled = model.RetypePageHIT.disable_all()
-        del self.server[:]
+        dry_run = bool(dry_run)
+        disabled = model.RetypePageHIT.disable_all(dry_run=dry_run)
+        removed = model.MTurkConversionJob.remove_many(dry_run=dry_run)
+        if dry_run:
+            return f'Would disable {disabled} HITs and remove {removed} jobs.'
         return (
-            'Disabled {disabled} HITs (do not forget to remove them '
-            'from other servers).'
+            'Disabled {disabled} HITs and removed {removed} jobs (do not forget '
+            'to remove them from other servers).'
         ).format(**locals())
 
+    @cherrypy.expose
+    def aws_stats(self):
+        """
+        Report the calls made to MTurk by this process and their timing.
+        """
+        cherrypy.response.headers['Content-Type'] = 'text/plain'
+        return str(aws.ConnectionFactory.stats)
+
     @cherrypy.expose
     def pay(self, job_id):
         """
@@ -325,7 +527,18 @@ class Admin:
         """
         job = self.server._get_job_for_id(job_id)
         job.authorized = True
-        job.register_hits()
+        job.update('authorized')
+
+        def notify(error):
+            self.server.send_notice(f"Error registering hits for {job_id}: {error}")
+
+        try:
+            job.register_hits_async(on_error=notify)
+        except errors.RegistrationInProgress:
+            return (
+                f'<a href="/status/{job_id}">HITs are already being registered; '
+                'click here for status.</a>'
+            )
         return (
             f'<a href="/status/{job_id}">Payment simulated; click here for status.</a>'
         )
@@ -364,6 +577,15 @@ def start_server(configs):
     ]
     list(map(admin_app.merge, devel_configs))
     cherrypy.tree.mount(GGCServer(), '/ggc')
+    poller.subscribe(app.config.get('hit_poller', {}))
+    server.queue_uploads = uploads.subscribe(
+        app.config.get('upload_queue', {}), server.send_notice
+    )
+    sync.subscribe(app.config.get('dropbox_sync', {}), server.send_notice)
+    model.ConversionJob.configure(app.config.get('conversion', {}))
+    balance_ttl = app.config.get('mturk', {}).get('balance_ttl')
+    if balance_ttl is not None:
+        aws.balance.cache.ttl = balance_ttl
     if not cherrypy.config.get('server.production', False):
         boto3.set_stream_logger('recapturedocs')
     server.send_notice(
@@ -378,6 +600,9 @@ def start_server(configs):
 
 
 class Command(metaclass=meta.LeafClassesMeta):
+    ensure_indexes = True
+    "Create any missing indexes when connecting to the database"
+
     def __init__(self, *configs):
         self.configs = configs
         self.configure()
@@ -397,6 +622,7 @@ class Command(metaclass=meta.LeafClassesMeta):
                 'tools.encode.on': True,
                 'tools.encode.encoding': 'utf-8',
                 'tools.agent_parser.on': True,
+                'tools.job_map.on': True,
             },
         }
         static_dir = pkg_resources.resource_filename('recapturedocs', 'static')
@@ -410,7 +636,7 @@ class Command(metaclass=meta.LeafClassesMeta):
         # TODO: consider doing persistence setup as a cherrypy plugin
         cherrypy._whole_config = cherrypy.lib.reprconf.Config()
         list(map(cherrypy._whole_config.update, self.configs))
-        persistence.init()
+        persistence.init(ensure_indexes=self.ensure_indexes)
 
     @classmethod
     def add_subparsers(cls, parser):
@@ -440,6 +666,28 @@ class Serve(Command):
         raise SystemExit(0)
 
 
+class Cluster(Command):
+    """
+    Serve with several supervised server processes on consecutive
+    ports from the configured port, as the members of the nginx
+    upstream pool. Send SIGHUP to restart them gracefully.
+    """
+
+    def __init__(self, *configs):
+        self.user_configs = configs
+        super().__init__(*configs)
+
+    def run(self):
+        settings = cherrypy._whole_config.get('cluster', {})
+        supervisor = cluster.Supervisor(
+            workers=settings.get('workers', os.cpu_count()),
+            base_port=cherrypy.config['server.socket_port'],
+            host=cherrypy.config['server.socket_host'],
+            args=self.user_configs,
+        )
+        supervisor.run()
+
+
 class Interact(Command):
     def configure(self):
         # change some config that's problemmatic in interactive mode
@@ -471,6 +719,55 @@ class Daemon(Command):
             cherrypy.engine.block()
 
 
+class Worker(Command):
+    """
+    Process queued uploads, for servers configured to leave that to a
+    separate process (upload_queue.worker = False).
+    """
+
+    def run(self):
+        whole_config = cherrypy._whole_config
+        notify = functools.partial(send_notice, whole_config.get('notification'))
+        model.ConversionJob.configure(whole_config.get('conversion', {}))
+        params = whole_config.get('upload_queue', {})
+        params = {key: params[key] for key in ('frequency',) if key in params}
+        uploads.UploadWorker(
+            cherrypy.engine, uploads.queue, notify, **params
+        ).subscribe()
+        if hasattr(cherrypy.engine, "signal_handler"):
+            cherrypy.engine.signal_handler.subscribe()
+        cherrypy.engine.start()
+        cherrypy.engine.block()
+
+
+class MigratePages(Command):
+    """
+    Move page content embedded in job documents into the page store,
+    re-save legacy (jsonpickle-encoded) jobs with the job codec and
+    record the HITs of existing jobs in the hits index.
+    """
+
+    def run(self):
+        migrated = model.ConversionJob.migrate_pages()
+        print(f"Migrated pages for {migrated} jobs")
+        indexed = model.MTurkConversionJob.index_all_hits()
+        print(f"Indexed HITs for {indexed} jobs")
+
+
+class IndexReport(Command):
+    """
+    Report the indexes missing from the database, those it has beyond
+    the declared ones and those mongod hasn't seen used. Indexes are
+    not ensured first, so missing ones are reported rather than built.
+    """
+
+    ensure_indexes = False
+
+    def run(self):
+        for line in persistence.index_report(persistence.store):
+            print(line)
+
+
 def get_package_config(name):
     name = name if name.endswith('.conf') else name + '.conf'
     pkg_res = functools.partial(pkg_resources.resource_filename, 'recapturedocs')
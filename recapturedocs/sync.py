@@ -0,0 +1,128 @@
+"""
+Background ingestion of PDFs from linked Dropbox accounts. Each
+account's delta cursor is kept with its token in the
+dropbox.tokens collection, so each sync fetches only the files
+changed since the last.
+"""
+
+import contextlib
+import logging
+import posixpath
+import shutil
+import tempfile
+
+import cherrypy
+from cherrypy.process import plugins
+
+from . import dropbox, model, persistence
+
+log = logging.getLogger(__name__)
+
+
+def is_pdf(metadata):
+    """
+    Is the delta entry with metadata a PDF file (rather than a folder
+    or a removed file)?
+
+    >>> is_pdf(dict(is_dir=False, mime_type='application/pdf'))
+    True
+    >>> is_pdf(None)
+    False
+    """
+    return bool(metadata) and metadata.get('mime_type') == 'application/pdf'
+
+
+class DropboxSync(plugins.Monitor):
+    """
+    A CherryPy engine plugin that, every ``frequency`` seconds, fetches
+    the PDFs added or changed in each linked account and creates a job
+    for each, unless a job was already created from the same content.
+    Jobs are created with server_url as the URL for their HITs, and
+    notify is called with a message for each.
+
+    An account synced for the first time (or reset by Dropbox) lists
+    all its files; those already ingested are skipped by their hash.
+    """
+
+    spool_size = 2**22
+    "Bytes of a file held in memory before it's spooled to disk"
+
+    def __init__(
+        self,
+        bus,
+        server_url,
+        notify,
+        frequency=5 * 60,
+        job_class=model.MTurkConversionJob,
+    ):
+        super().__init__(bus, self.sync, frequency=frequency, name='DropboxSync')
+        self.server_url = server_url
+        self.notify = notify
+        self.job_class = job_class
+
+    def sync(self):
+        for token_info in persistence.store.dropbox.tokens.find():
+            try:
+                self.sync_account(token_info)
+            except Exception:
+                log.exception("Error syncing Dropbox account %s", token_info['_id'])
+
+    def sync_account(self, token_info):
+        """
+        Ingest the changes to the account since its saved cursor, saving
+        the cursor after each batch, so an interrupted sync resumes from
+        the last batch ingested.
+        """
+        client = dropbox.load_client(token_info)
+        cursor = token_info.get('cursor')
+        has_more = True
+        while has_more:
+            delta = client.delta(cursor)
+            # entry paths are lowercased; the metadata has the actual path
+            for _, metadata in delta['entries']:
+                if is_pdf(metadata):
+                    self.ingest(client, metadata['path'])
+            cursor, has_more = delta['cursor'], delta['has_more']
+            persistence.store.dropbox.tokens.update_one(
+                {'_id': token_info['_id']}, {'$set': {'cursor': cursor}}
+            )
+
+    def ingest(self, client, path):
+        """
+        Create and save a job from the file at path, unless a job was
+        already created from the same content. Return the job, or None
+        if the file was skipped.
+        """
+        with tempfile.SpooledTemporaryFile(self.spool_size) as stream:
+            with contextlib.closing(client.get_file(path)) as source:
+                shutil.copyfileobj(source, stream)
+            stream.seek(0)
+            upload_hash = self.job_class.hash_upload(stream)
+            if self.job_class.id_for_upload(upload_hash) is not None:
+                return None
+            try:
+                job = self.job_class(
+                    stream,
+                    'application/pdf',
+                    self.server_url,
+                    posixpath.basename(path),
+                    upload_hash,
+                )
+            except Exception:
+                # a file that can't be split won't be retried until it changes
+                log.exception("Unable to create a job from %s", path)
+                return None
+        if job.save_if_new():
+            self.notify(f"A new document was synced from Dropbox ({job.id})")
+        return job
+
+
+def subscribe(config, notify):
+    """
+    Subscribe a DropboxSync to the engine if enabled in config, which
+    must give the server_url for the jobs' HITs.
+    """
+    if not config.get('on', False):
+        return
+    params = {key: config[key] for key in ('frequency',) if key in config}
+    DropboxSync(cherrypy.engine, config['server_url'], notify, **params).subscribe()
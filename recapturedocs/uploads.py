@@ -0,0 +1,174 @@
+"""
+A durable queue of uploaded documents. Uploads are accepted at once
+and split into jobs, saved and announced by an UploadWorker, running
+in the server or in a separate process (the ``worker`` command).
+"""
+
+import datetime
+import logging
+
+import cherrypy
+import gridfs
+import pymongo
+from cherrypy.process import plugins
+
+from . import model
+
+log = logging.getLogger(__name__)
+
+queue = None
+"The UploadQueue for this process, set by init()"
+
+
+def init(db):
+    globals().update(queue=UploadQueue(db))
+
+
+def _now():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+class UploadQueue:
+    """
+    Uploads awaiting processing, keyed by upload hash, with the upload
+    content in GridFS.
+
+    A worker claims an upload by leasing it for ``lease_time`` seconds;
+    if the worker dies, the upload is claimed again once the lease
+    expires. A failed upload is retried after ``retry_delay`` seconds,
+    up to ``max_attempts`` attempts (including those of workers that
+    died), then marked failed and its content discarded. Uploading the
+    same content again retries it.
+    """
+
+    lease_time = 10 * 60
+    retry_delay = 60
+    max_attempts = 3
+
+    def __init__(self, db, collection='upload_queue'):
+        self.entries = db[collection]
+        self.files = gridfs.GridFS(db, collection=collection)
+
+    def put(self, stream, content_type, server_url, filename, upload_hash, job_class):
+        """
+        Queue the upload in stream, unless it's already queued. An
+        upload that failed is queued again.
+        """
+        stream.seek(0)
+        try:
+            self.files.put(stream, _id=upload_hash)
+        except gridfs.errors.FileExists:
+            pass
+        entry = dict(
+            status='pending',
+            content_type=content_type,
+            server_url=server_url,
+            filename=filename,
+            job_class=job_class.__name__,
+            attempts=0,
+            available=_now(),
+        )
+        try:
+            self.entries.insert_one(dict(entry, _id=upload_hash))
+        except pymongo.errors.DuplicateKeyError:
+            retry = {'$set': entry, '$unset': {'error': ''}}
+            self.entries.update_one({'_id': upload_hash, 'status': 'failed'}, retry)
+
+    def get(self, upload_hash):
+        """
+        Return the entry for the queued upload, if any.
+        """
+        return self.entries.find_one({'_id': upload_hash})
+
+    def claim(self):
+        """
+        Lease the next pending upload, or return None if there's none.
+        An upload claimed more than max_attempts times (by workers that
+        died processing it) is marked failed instead.
+        """
+        while True:
+            now = _now()
+            lease = datetime.timedelta(seconds=self.lease_time)
+            entry = self.entries.find_one_and_update(
+                {'status': 'pending', 'available': {'$lte': now}},
+                {'$set': {'available': now + lease}, '$inc': {'attempts': 1}},
+                sort=[('available', 1)],
+                return_document=pymongo.ReturnDocument.AFTER,
+            )
+            if entry is None or entry['attempts'] <= self.max_attempts:
+                return entry
+            self._give_up(entry, "Processing did not complete")
+
+    def process(self, entry, notify):
+        """
+        Create and save the job for a claimed upload, then remove the
+        upload from the queue.
+        """
+        job_class = getattr(model, entry['job_class'])
+        with self.files.get(entry['_id']) as stream:
+            job = job_class(
+                stream,
+                entry['content_type'],
+                entry['server_url'],
+                entry['filename'],
+                entry['_id'],
+            )
+        job.save_if_new()
+        notify(f"A new document was uploaded ({job.id})")
+        self.entries.delete_one({'_id': entry['_id']})
+        self.files.delete(entry['_id'])
+
+    def fail(self, entry, error):
+        """
+        Record the failure of a claimed upload, to be retried later or,
+        after max_attempts, marked failed.
+        """
+        if entry['attempts'] >= self.max_attempts:
+            self._give_up(entry, error)
+            return
+        retry = _now() + datetime.timedelta(seconds=self.retry_delay)
+        update = dict(error=str(error), available=retry)
+        self.entries.update_one({'_id': entry['_id']}, {'$set': update})
+
+    def _give_up(self, entry, error):
+        """
+        Mark the upload failed and discard its content.
+        """
+        update = dict(status='failed', error=str(error))
+        self.entries.update_one({'_id': entry['_id']}, {'$set': update})
+        self.files.delete(entry['_id'])
+
+
+class UploadWorker(plugins.Monitor):
+    """
+    A CherryPy engine plugin that, every ``frequency`` seconds, processes
+    the pending uploads in the queue, calling notify with a message for
+    each job created.
+    """
+
+    def __init__(self, bus, queue, notify, frequency=5):
+        super().__init__(bus, self.work, frequency=frequency, name='UploadWorker')
+        self.queue = queue
+        self.notify = notify
+
+    def work(self):
+        for entry in iter(self.queue.claim, None):
+            try:
+                self.queue.process(entry, self.notify)
+            except Exception as error:
+                log.exception("Error processing upload %s", entry['_id'])
+                self.queue.fail(entry, error)
+
+
+def subscribe(config, notify):
+    """
+    Subscribe an UploadWorker to the engine, unless the queue is
+    disabled or processed by a separate worker in config. Return True
+    if uploads should be queued.
+    """
+    if not config.get('on', True):
+        return False
+    if config.get('worker', True):
+        params = {key: config[key] for key in ('frequency',) if key in config}
+        UploadWorker(cherrypy.engine, queue, notify, **params).subscribe()
+    return True
@@ -0,0 +1,141 @@
+import botocore.exceptions
+import pytest
+
+from recapturedocs import aws, model
+
+
+class FlakyClient:
+    def __init__(self, failures):
+        self.failures = failures
+        self.calls = 0
+
+    def get_hit(self, HITId):
+        self.calls += 1
+        if self.calls <= self.failures:
+            error = {'Error': {'Code': 'ThrottlingException'}}
+            raise botocore.exceptions.ClientError(error, 'GetHIT')
+        return {'HIT': {'HITId': HITId}}
+
+
+@pytest.fixture
+def client(monkeypatch):
+    client = FlakyClient(failures=2)
+    monkeypatch.setattr(
+        aws.ConnectionFactory, 'get_mturk_connection', classmethod(lambda cls: client)
+    )
+    return client
+
+
+def test_gateway_retries_throttled_calls(client):
+    gateway = aws.Gateway(rate=100, backoff=0)
+    assert gateway.get_hits(['abc']) == [{'HITId': 'abc'}]
+    assert client.calls == 3
+    assert gateway.bucket.rate < 100
+
+
+def test_gateway_gives_up(client):
+    gateway = aws.Gateway(rate=100, backoff=0, max_attempts=2)
+    with pytest.raises(botocore.exceptions.ClientError):
+        gateway.call('get_hit', HITId='abc')
+
+
+class PagedClient:
+    pages = {None: (['a', 'b'], 't1'), 't1': (['c'], 't2'), 't2': (['d'], None)}
+
+    def list_hits(self, MaxResults, NextToken=None):
+        items, token = self.pages[NextToken]
+        return dict(HITs=items, **(dict(NextToken=token) if token else {}))
+
+
+@pytest.mark.parametrize('prefetch', [False, True])
+def test_paginate(monkeypatch, prefetch):
+    client = PagedClient()
+    monkeypatch.setattr(
+        aws.ConnectionFactory, 'get_mturk_connection', classmethod(lambda cls: client)
+    )
+    gateway = aws.Gateway(rate=100)
+    items = gateway.paginate('list_hits', 'HITs', prefetch=prefetch, MaxResults=2)
+    assert list(items) == ['a', 'b', 'c', 'd']
+
+
+def test_account_balance_cached_and_reserved():
+    calls = []
+
+    class Gateway:
+        def call(self, operation):
+            calls.append(operation)
+            return {'AvailableBalance': '10.00'}
+
+    balance = aws.AccountBalance(gateway=Gateway())
+    assert balance.available() == balance.available() == 10
+    with balance.reserve('job', 4):
+        assert balance.available() == 6
+        with balance.reserve('job', 1):
+            assert balance.available() == 5
+        assert balance.available() == 6
+    assert balance.available() == 10
+    assert calls == ['get_account_balance'] * 3
+
+
+class Reservations(dict):
+    def insert_one(self, doc):
+        self[doc['_id']] = doc
+
+    def delete_one(self, query):
+        del self[query['_id']]
+
+    def aggregate(self, pipeline):
+        amounts = [doc['amount'] for doc in self.values()]
+        return iter([dict(_id=None, total=sum(amounts))] if amounts else [])
+
+
+def test_reservations_shared():
+    class Gateway:
+        def call(self, operation):
+            return {'AvailableBalance': '10.00'}
+
+    collection = Reservations()
+    balances = [aws.AccountBalance(gateway=Gateway()) for _ in range(2)]
+    for balance in balances:
+        balance.reservations = aws.SharedReservations(collection)
+    with balances[0].reserve('job', 4):
+        assert balances[1].available() == 6
+    assert balances[1].available() == 10
+    assert not collection
+
+
+class HITClient:
+    def __init__(self):
+        self.calls = []
+
+    def create_hit_type(self, **params):
+        self.calls.append(('create_hit_type', params))
+        return dict(HITTypeId='type', ResponseMetadata={})
+
+    def list_hits(self, MaxResults, NextToken=None):
+        hits = [dict(HITId='a', HITTypeId='type'), dict(HITId='b', HITTypeId='other')]
+        return dict(HITs=hits)
+
+    def update_expiration_for_hit(self, HITId, ExpireAt):
+        self.calls.append(('update_expiration_for_hit', HITId))
+
+    def delete_hit(self, HITId):
+        self.calls.append(('delete_hit', HITId))
+
+
+def test_disable_all(monkeypatch):
+    client = HITClient()
+    monkeypatch.setattr(
+        aws.ConnectionFactory, 'get_mturk_connection', classmethod(lambda cls: client)
+    )
+    monkeypatch.setattr(aws, 'gateway', aws.Gateway(rate=100))
+    try:
+        assert model.RetypePageHIT.disable_all(dry_run=True) == 1
+        assert model.RetypePageHIT.disable_all() == 1
+    finally:
+        # forget the memoized HIT type
+        vars(model.RetypePageHIT)['get_hit_type'].__func__.reset()
+    ((operation, params), *calls) = client.calls
+    assert operation == 'create_hit_type'
+    assert params['Reward'] == '1.00'
+    assert calls == [('update_expiration_for_hit', 'a'), ('delete_hit', 'a')]
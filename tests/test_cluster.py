@@ -0,0 +1,43 @@
+import time
+
+from recapturedocs import cluster
+
+
+class CrashingWorker(cluster.Worker):
+    def __init__(self):
+        self.index = 0
+        self.starts = 0
+        self.crashes = 0
+        self.restart_at = None
+
+    def start(self):
+        self.starts += 1
+        self.started = time.monotonic()
+        self.restart_at = None
+
+    def running(self):
+        return False
+
+
+def test_crashing_worker_restarted_with_backoff(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, 'monotonic', lambda: now[0])
+    supervisor = cluster.Supervisor.__new__(cluster.Supervisor)
+    supervisor.stopping = False
+    worker = CrashingWorker()
+    supervisor.workers = [worker]
+    worker.start()
+    delays = []
+    for crash in range(8):
+        supervisor.restart_exited()
+        delays.append(worker.restart_at - now[0])
+        now[0] = worker.restart_at
+        supervisor.restart_exited()
+    assert delays == [1, 2, 4, 8, 16, 32, 60, 60]
+    assert worker.starts == 9
+
+    # a worker that ran for a while is restarted at once
+    now[0] += worker.min_uptime
+    supervisor.restart_exited()
+    assert worker.starts == 10
+    assert worker.crashes == 0
@@ -0,0 +1,42 @@
+import jaraco.modb
+import pytest
+
+from recapturedocs import codec, pages
+from recapturedocs.model import ConversionJob, MTurkConversionJob, RetypePageHIT
+
+
+def test_round_trip(sample_stream):
+    job = MTurkConversionJob(sample_stream, 'application/pdf', server_url='http://x/')
+    job.hits = [RetypePageHIT(job.server_url) for _ in range(len(job))]
+    job.hits[0].registration_result = dict(HIT=dict(HITId='abc'))
+    data = codec.encode(job)
+    assert data['_type'] == 'MTurkConversionJob'
+    assert data['pages']['content'][0].startswith(b'%PDF')
+    assert 'stream' not in data
+    restored = codec.decode(data)
+    assert type(restored) is MTurkConversionJob
+    assert restored.id == job.id
+    assert list(restored.pages) == list(job.pages)
+    assert restored.hits[0].registration_result == dict(HIT=dict(HITId='abc'))
+    assert not restored.hits[1].is_registered()
+
+
+def test_page_refs_round_trip():
+    field = codec.Pages()
+    restored = field.decode(field.encode(pages.PageList(['a', 'b'])))
+    assert isinstance(restored, pages.PageList)
+    assert restored.refs == ['a', 'b']
+
+
+def test_legacy_documents(sample_stream):
+    job = ConversionJob(sample_stream, 'application/pdf', server_url=None)
+    restored = codec.decode(jaraco.modb.encode(job))
+    assert type(restored) is ConversionJob
+    assert restored.id == job.id
+
+
+def test_newer_version_rejected(sample_stream):
+    job = ConversionJob(sample_stream, 'application/pdf', server_url=None)
+    data = dict(codec.encode(job), _version=codec.version + 1)
+    with pytest.raises(ValueError):
+        codec.decode(data)
@@ -0,0 +1,76 @@
+import datetime
+import types
+
+from recapturedocs import dashboard, persistence
+
+
+class FakeCollection:
+    """
+    Returns the page for pipelines with a $sort, otherwise the totals.
+    """
+
+    def __init__(self, page=(), totals=()):
+        self.page = list(page)
+        self.totals = list(totals)
+        self.pipelines = []
+
+    def aggregate(self, pipeline):
+        self.pipelines.append(pipeline)
+        if any('$sort' in stage for stage in pipeline):
+            return iter(self.page)
+        return iter(self.totals)
+
+
+def job_doc(id, day):
+    created = datetime.datetime(2024, 5, day)
+    summary = dict(filename=f'{id}.pdf', page_count=2, created=created)
+    return dict(_id=id, summary=summary, outstanding=0, complete=True)
+
+
+def use_store(monkeypatch, jobs, hits):
+    store = types.SimpleNamespace(jobs=jobs, hits=hits)
+    monkeypatch.setattr(persistence, 'store', store, raising=False)
+
+
+def stage_names(pipeline):
+    return [name for stage in pipeline for name in stage]
+
+
+def test_dashboard_page(monkeypatch):
+    docs = [job_doc('c', 3), job_doc('b', 2), job_doc('a', 1)]
+    jobs = FakeCollection(page=docs, totals=[dict(_id=None, jobs=3, pages=6)])
+    hits = FakeCollection(totals=[dict(count=4)])
+    use_store(monkeypatch, jobs, hits)
+    board = dashboard.Dashboard(dashboard.job_filter(), limit=2)
+    assert [job.id for job in board.jobs] == ['c', 'b']
+    assert board.jobs[0].complete is True
+    assert board.next == '2024-05-02T00:00:00_b'
+    assert board.totals['cost'] == board.job_class.page_cost * 6
+    assert board.totals['outstanding'] == 4
+    assert '_id' not in board.totals
+    # the page is limited before the progress of its jobs is looked up
+    page, totals = jobs.pipelines
+    assert stage_names(page)[:4] == ['$match', '$sort', '$limit', '$project']
+    assert '$lookup' not in stage_names(totals)
+
+
+def test_dashboard_complete_filter(monkeypatch):
+    jobs = FakeCollection(totals=[dict(_id=None, jobs=1, pages=2, outstanding=0)])
+    hits = FakeCollection()
+    use_store(monkeypatch, jobs, hits)
+    board = dashboard.Dashboard(dashboard.job_filter(), complete=True)
+    assert board.totals['jobs'] == 1
+    page, totals = jobs.pipelines
+    assert stage_names(page)[-2:] == ['$match', '$limit']
+    assert '$lookup' in stage_names(totals)
+    assert not hits.pipelines
+
+
+def test_dashboard_empty(monkeypatch):
+    jobs = FakeCollection()
+    use_store(monkeypatch, jobs, FakeCollection())
+    board = dashboard.Dashboard(dashboard.job_filter(), after='2024-05-02T00:00:00_b')
+    assert board.jobs == [] and board.next is None
+    assert board.totals == dict(jobs=0, pages=0, outstanding=0, cost=0)
+    page, totals = jobs.pipelines
+    assert '$and' in page[0]['$match']
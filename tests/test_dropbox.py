@@ -0,0 +1,91 @@
+import concurrent.futures
+import datetime
+import pathlib
+import threading
+import types
+
+import genshi.template
+
+from recapturedocs import cache, dropbox, persistence, server
+
+
+class TokenCollection(dict):
+    def insert_one(self, doc):
+        self[doc['_id']] = doc
+
+    def find_one_and_delete(self, query):
+        doc = self.get(query['_id'])
+        if doc is None or doc['issued'] <= query['issued']['$gt']:
+            return None
+        return self.pop(query['_id'])
+
+
+def test_request_tokens(monkeypatch):
+    monkeypatch.setattr(dropbox, 'request_token', lambda key, secret: (key, secret))
+    tokens = dropbox.RequestTokens(TokenCollection())
+    tokens.put(types.SimpleNamespace(key='key', secret='secret'))
+    assert tokens.pop('key') == ('key', 'secret')
+    assert tokens.pop('key') is None
+
+
+def test_request_tokens_expire():
+    collection = TokenCollection()
+    tokens = dropbox.RequestTokens(collection)
+    tokens.put(types.SimpleNamespace(key='key', secret='secret'))
+    collection['key']['issued'] -= datetime.timedelta(seconds=tokens.ttl + 1)
+    assert tokens.pop('key') is None
+
+
+def test_list_omits_slow_accounts(monkeypatch):
+    release = threading.Event()
+
+    def pdf_list(client):
+        if client == 'slow':
+            release.wait(5)
+        return client, [f'/{client}.pdf']
+
+    tokens = types.SimpleNamespace(find=lambda: [dict(_id='fast'), dict(_id='slow')])
+    store = types.SimpleNamespace(dropbox=types.SimpleNamespace(tokens=tokens))
+    monkeypatch.setattr(persistence, 'store', store, raising=False)
+    monkeypatch.setattr(dropbox, 'load_client', lambda info: info['_id'])
+    monkeypatch.setattr(dropbox, 'pdf_list', pdf_list)
+    view = pathlib.Path(server.__file__).parent / 'view'
+    loader = genshi.template.TemplateLoader([str(view / 'ggc'), str(view)])
+    monkeypatch.setattr(server.GGCServer, 'tl', loader)
+    monkeypatch.setattr(server.GGCServer, 'listings', cache.TTLCache(ttl=60))
+    monkeypatch.setattr(server.GGCServer, 'listing_timeout', 0.2)
+    pool = concurrent.futures.ThreadPoolExecutor(2)
+    monkeypatch.setattr(server.GGCServer, 'listing_pool', pool)
+    try:
+        # views waiting on the slow account don't take up the pool
+        pages = [server.GGCServer().list() for view in range(4)]
+    finally:
+        release.set()
+    for page in pages:
+        assert '/fast.pdf' in page
+        assert '/slow.pdf' not in page
+        assert '1 accounts could not be listed' in page
+
+
+class AccessTokens(dict):
+    def update_one(self, query, update, upsert=False):
+        self.setdefault(query['_id'], dict(query)).update(update['$set'])
+
+
+def test_save_token_keeps_cursor(monkeypatch):
+    tokens = AccessTokens(uid=dict(_id='uid', key='old', cursor='c1'))
+    store = types.SimpleNamespace(dropbox=types.SimpleNamespace(tokens=tokens))
+    monkeypatch.setattr(persistence, 'store', store, raising=False)
+    access_token = types.SimpleNamespace(key='key', secret='secret')
+    session = types.SimpleNamespace(obtain_access_token=lambda token: access_token)
+    monkeypatch.setattr(dropbox, 'get_session', lambda: session)
+    client = types.SimpleNamespace(account_info=lambda: dict(display_name='Pat'))
+    monkeypatch.setattr(dropbox, 'get_client', lambda sess: client)
+    request_tokens = types.SimpleNamespace(pop=lambda key: 'request token')
+    monkeypatch.setattr(server.GGCServer, 'request_tokens', lambda self: request_tokens)
+    view = pathlib.Path(server.__file__).parent / 'view'
+    loader = genshi.template.TemplateLoader([str(view / 'ggc'), str(view)])
+    monkeypatch.setattr(server.GGCServer, 'tl', loader)
+    page = server.GGCServer().save_token('request key', 'uid')
+    assert 'Welcome, Pat' in page
+    assert tokens['uid'] == dict(_id='uid', key='key', secret='secret', cursor='c1')
@@ -14,14 +14,10 @@ class TestRetypePageHIT:
         hit = model.RetypePageHIT('https://localhost/foo')
         hit.register()
         assert hasattr(hit, 'registration_result')
-        assert len(hit.registration_result) == 1
-        mturk_hit = hit.registration_result[0]
-        # TODO: what object is returned?
-        # assert isinstance(mturk_hit, HIT)
-        assert mturk_hit.IsValid == 'True'
-        assert len(mturk_hit.HITId) == 30
-        assert mturk_hit.HITId == hit.id
-        assert mturk_hit.HITTypeId == hit.get_hit_type()
+        mturk_hit = hit.registration_result['HIT']
+        assert len(mturk_hit['HITId']) == 30
+        assert mturk_hit['HITId'] == hit.id
+        assert mturk_hit['HITTypeId'] == hit.get_hit_type()
 
 
 class TestConversionJob:
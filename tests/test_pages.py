@@ -0,0 +1,94 @@
+import types
+
+import jaraco.modb
+import pytest
+
+from recapturedocs import pages
+from recapturedocs.model import ConversionJob
+
+
+class DictPageStore(dict):
+    def put(self, data):
+        ref = pages.page_ref(data)
+        self.setdefault(ref, data)
+        return ref
+
+    def get(self, ref):
+        return self[ref]
+
+
+def test_page_list_stores_references(sample_stream, monkeypatch):
+    store = DictPageStore()
+    monkeypatch.setattr(pages, 'store', store)
+    job = ConversionJob(sample_stream, 'application/pdf', server_url=None)
+    assert isinstance(job.pages, pages.PageList)
+    assert len(store) == len(job) == 4
+    data = jaraco.modb.encode(job)
+    assert data['pages']['py/state'] == dict(refs=job.pages.refs)
+    restored = jaraco.modb.decode(data)
+    assert restored.id == job.id
+
+
+def test_duplicate_pages_stored_once(sample_stream, monkeypatch):
+    store = DictPageStore()
+    monkeypatch.setattr(pages, 'store', store)
+    ConversionJob(sample_stream, 'application/pdf', server_url=None)
+    sample_stream.seek(0)
+    ConversionJob(sample_stream, 'application/pdf', server_url=None)
+    assert len(store) == 4
+
+
+class FileDocs(dict):
+    """
+    The files collection of a GridFS bucket, with its fs.put.
+    """
+
+    def put(self, data, _id, stored):
+        self[_id] = dict(_id=_id, stored=stored)
+
+    def update_one(self, query, update):
+        doc = self.get(query['_id'])
+        if doc:
+            doc.update(update['$set'])
+        return types.SimpleNamespace(matched_count=int(bool(doc)))
+
+    def delete_one(self, query):
+        doc = self.get(query['_id'])
+        stale = doc and not doc['stored'] >= query['stored']['$not']['$gte']
+        if stale:
+            del self[query['_id']]
+        return types.SimpleNamespace(deleted_count=int(bool(stale)))
+
+
+class Chunks(list):
+    def delete_many(self, query):
+        self.append(query['files_id'])
+
+
+def test_recently_stored_pages_kept():
+    store = pages.PageStore.__new__(pages.PageStore)
+    store.fs = store.files = FileDocs()
+    store.chunks = Chunks()
+    ref = store.put(b'page')
+    store.collect(ref)
+    assert ref in store.files
+    # stored again by a job yet to be saved
+    store.files[ref]['stored'] -= store.grace * 2
+    assert store.put(b'page') == ref
+    store.collect(ref)
+    assert ref in store.files
+    store.files[ref]['stored'] -= store.grace * 2
+    store.collect(ref)
+    assert ref not in store.files
+    assert store.chunks == [ref]
+
+
+def test_page_file_not_left_on_error(tmp_path):
+    files = pages.PageFiles(tmp_path, max_size=10)
+
+    def open_source():
+        raise OSError("Page store unavailable")
+
+    with pytest.raises(OSError):
+        files.materialize('abc', open_source)
+    assert list((tmp_path / 'ab').iterdir()) == []
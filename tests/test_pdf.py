@@ -7,3 +7,16 @@ here = os.path.dirname(__file__)
 
 def test_split_pdf(sample_stream):
     ConversionJob.split_pdf(sample_stream)
+
+
+def test_split_pdf_parallel(sample_stream, monkeypatch):
+    serial = ConversionJob.split_pdf(sample_stream)
+    sample_stream.seek(0)
+    monkeypatch.setattr(ConversionJob, 'split_parallel_threshold', 2)
+    assert ConversionJob.split_pdf(sample_stream, workers=3) == serial
+
+
+def test_spooled_pages_match_split(sample_stream):
+    job = ConversionJob(sample_stream, 'application/pdf', server_url=None)
+    sample_stream.seek(0)
+    assert list(job.pages) == ConversionJob.split_pdf(sample_stream)
@@ -1,5 +1,13 @@
+import hashlib
+import itertools
 import pickle
+import types
 
+import botocore.exceptions
+import pymongo
+import pytest
+
+from recapturedocs import aws, errors, model, pages, persistence
 from recapturedocs.model import ConversionJob
 
 
@@ -14,3 +22,314 @@ def test_same_job_matches(sample_stream):
     sample_stream.seek(0)
     job2 = ConversionJob(**params)
     assert job1.matches(job2)
+
+
+def test_job_id_cached_until_pages_change(sample_stream):
+    job = ConversionJob(sample_stream, content_type='application/pdf', server_url=None)
+    expected = hashlib.md5(b''.join(job.pages)).hexdigest()
+    assert job._hash == job.id == expected
+    job.pages = job.pages[:1]
+    assert job.id == hashlib.md5(job.pages[0]).hexdigest()
+
+
+def test_upload_hash(sample_stream):
+    expected = hashlib.md5(sample_stream.read()).hexdigest()
+    sample_stream.seek(0)
+    job = ConversionJob(sample_stream, content_type='application/pdf', server_url=None)
+    assert job.upload_hash == expected
+
+
+def test_identity_map_memoizes_for_unit(sample_stream):
+    job = ConversionJob(sample_stream, content_type='application/pdf', server_url=None)
+    assert job.cost is not job.cost
+    model.identity_map.begin()
+    try:
+        assert job.cost is job.cost
+    finally:
+        model.identity_map.end()
+    assert job.cost is not job.cost
+
+
+def test_job_summary_loads_job_only_when_needed(sample_stream):
+    job = ConversionJob(sample_stream, content_type='application/pdf', server_url=None)
+    loaded = []
+
+    class Jobs:
+        def load(id):
+            loaded.append(id)
+            return job
+
+    summary = model.JobSummary(Jobs, dict(_id=job.id, summary=job._summary()))
+    assert len(summary) == len(job)
+    assert summary.authorized is False
+    assert not loaded
+    assert summary.pages is job.pages
+    assert loaded == [job.id]
+    legacy = model.JobSummary(Jobs, dict(_id=job.id))
+    assert len(legacy) == len(job)
+
+
+class FakeCollection(list):
+    """
+    Just enough of a Mongo collection for queries on $in conditions.
+    """
+
+    def _select(self, query):
+        def values(doc, key):
+            if key in model._page_ref_fields:
+                return model._page_refs(doc)
+            return [doc.get(key)]
+
+        return [
+            doc
+            for doc in self
+            if all(
+                any(value in cond['$in'] for value in values(doc, key))
+                for key, cond in query.items()
+            )
+        ]
+
+    def find(self, query, projection=None):
+        self.projection = projection
+        return self._select(query)
+
+    def count_documents(self, query):
+        return len(self._select(query))
+
+    def delete_many(self, query):
+        selected = self._select(query)
+        self[:] = [doc for doc in self if doc not in selected]
+        return types.SimpleNamespace(deleted_count=len(selected))
+
+    def distinct(self, key, query):
+        return [ref for doc in self._select(query) for ref in model._page_refs(doc)]
+
+
+def test_remove_many(monkeypatch):
+    def job(id, refs):
+        return {'_id': id, 'pages': {'refs': refs}}
+
+    jobs = FakeCollection([job('a', ['p1', 'p2']), job('b', ['p2']), job('c', [])])
+    hits = FakeCollection([dict(_id='h1', job_id='a'), dict(_id='h2', job_id='c')])
+    store = types.SimpleNamespace(jobs=jobs, hits=hits, uploads=FakeCollection())
+    monkeypatch.setattr(persistence, 'store', store, raising=False)
+    page_store = {'p1': b'1', 'p2': b'2'}
+    page_store = types.SimpleNamespace(collect=page_store.pop, data=page_store)
+    monkeypatch.setattr(pages, 'store', page_store)
+
+    assert ConversionJob.remove_many(ids=['a', 'c'], dry_run=True) == 2
+    assert len(jobs) == 3
+    assert ConversionJob.remove_many(ids=['a', 'c']) == 2
+    assert [doc['_id'] for doc in jobs] == ['b']
+    assert [doc['_id'] for doc in hits] == []
+    assert list(page_store.data) == ['p2']
+    assert jobs.projection == {'pages.refs': True, 'pages.py/state.refs': True}
+
+
+class RecordingCollection:
+    def __init__(self, matched_count=1):
+        self.docs = {}
+        self.calls = []
+        self.matched_count = matched_count
+
+    def insert_one(self, doc):
+        if doc['_id'] in self.docs:
+            raise pymongo.errors.DuplicateKeyError('duplicate')
+        self.docs[doc['_id']] = doc
+
+    def find_one(self, query, projection=None):
+        return self.docs.get(query['_id'])
+
+    def delete_one(self, query):
+        self.docs.pop(query['_id'], None)
+
+    def replace_one(self, query, doc, upsert=False):
+        self.calls.append(('replace_one', doc))
+        self.docs[doc['_id']] = doc
+
+    def update_one(self, query, update, upsert=False):
+        self.calls.append(('update_one', update))
+        return types.SimpleNamespace(matched_count=self.matched_count)
+
+
+def use_store(monkeypatch, jobs):
+    store = types.SimpleNamespace(
+        jobs=jobs, uploads=RecordingCollection(), registrations=RecordingCollection()
+    )
+    monkeypatch.setattr(persistence, 'store', store, raising=False)
+    monkeypatch.setattr(pages, 'store', None)
+
+
+def test_save_if_new(sample_stream, monkeypatch):
+    jobs = RecordingCollection()
+    use_store(monkeypatch, jobs)
+    job = ConversionJob(sample_stream, content_type='application/pdf', server_url=None)
+    assert job.save_if_new()
+    assert not job.save_if_new()
+    assert list(jobs.docs) == [job.id]
+
+
+def test_update_sets_named_fields(sample_stream, monkeypatch):
+    jobs = RecordingCollection()
+    use_store(monkeypatch, jobs)
+    job = ConversionJob(sample_stream, content_type='application/pdf', server_url=None)
+    job.authorized = True
+    job.update('authorized')
+    ((method, update),) = jobs.calls
+    assert update == {'$set': {'authorized': True, 'summary.authorized': True}}
+
+
+def test_update_saves_legacy_job(sample_stream, monkeypatch):
+    jobs = RecordingCollection(matched_count=0)
+    use_store(monkeypatch, jobs)
+    job = ConversionJob(sample_stream, content_type='application/pdf', server_url=None)
+    job.update('authorized')
+    assert [method for method, arg in jobs.calls] == ['update_one', 'replace_one']
+
+
+def test_moving_pages_keeps_id(sample_stream, monkeypatch):
+    use_store(monkeypatch, RecordingCollection())
+    job = ConversionJob(sample_stream, content_type='application/pdf', server_url=None)
+    spool = job.pages
+    job.save()
+    assert job.pages is spool
+    stored = {}
+    page_store = types.SimpleNamespace(put=lambda data: stored.setdefault(data, data))
+    monkeypatch.setattr(pages, 'store', page_store)
+    data = job._document()
+    assert isinstance(job.pages, pages.PageList)
+    assert data['_hash'] == data['_id'] == job.id
+
+
+class IndexedCollection:
+    def __init__(self, names, unused=()):
+        self.names = names
+        self.unused = unused
+
+    def index_information(self):
+        return dict.fromkeys(self.names)
+
+    def aggregate(self, pipeline):
+        accesses = dict(ops=0, since='startup')
+        return [dict(name=name, accesses=accesses) for name in self.unused]
+
+
+def test_index_report():
+    db = dict(
+        jobs=IndexedCollection(['_id_', 'created', 'authorized_created', 'page_refs']),
+        hits=IndexedCollection(['_id_', 'job_page', 'outstanding', 'old']),
+        uploads=IndexedCollection(['_id_', 'job'], unused=['job']),
+        upload_queue=IndexedCollection(['_id_', 'available']),
+        registrations=IndexedCollection(['_id_', 'expiry']),
+        balance_reservations=IndexedCollection(['_id_', 'expiry']),
+        **{'dropbox.request_tokens': IndexedCollection(['_id_', 'expiry'])},
+    )
+    assert list(persistence.index_report(db)) == [
+        'Index hits.old is not declared',
+        'Index uploads.job unused since startup',
+    ]
+    del db['jobs'].names[1]
+    assert next(persistence.index_report(db)) == 'Index jobs.created is missing'
+
+
+class MTurkClient:
+    def __init__(self):
+        self.ids = itertools.count()
+        self.params = []
+
+    def create_hit(self, **params):
+        self.params.append(params)
+        hit = dict(HITId=f'hit{next(self.ids)}', HITTypeId='type', MaxAssignments=1)
+        return dict(HIT=hit, ResponseMetadata=dict(HTTPStatusCode=200))
+
+
+class HitIndex(dict):
+    def bulk_write(self, requests, ordered=True):
+        for request in requests:
+            id = request._filter['_id']
+            self.setdefault(id, dict(_id=id)).update(request._doc['$set'])
+
+    def find_one(self, query):
+        return self.get(query['_id'])
+
+
+def test_register_and_locate_hits(sample_stream, monkeypatch):
+    client = MTurkClient()
+    monkeypatch.setattr(
+        aws.ConnectionFactory, 'get_mturk_connection', classmethod(lambda cls: client)
+    )
+    use_store(monkeypatch, RecordingCollection())
+    monkeypatch.setattr(persistence.store, 'hits', HitIndex(), raising=False)
+    job = model.MTurkConversionJob(
+        sample_stream, 'application/pdf', 'http://localhost/process'
+    )
+    job.register_hits()
+    assert all(params['Reward'] == '1.00' for params in client.params)
+    assert sorted(job.hit_ids) == [f'hit{n}' for n in range(len(job))]
+    assert job.hits[0].max_assignments() == 1
+    for index, hit in enumerate(job.hits):
+        entry = model.MTurkConversionJob.locate_hit(hit.id)
+        assert entry['job_id'] == job.id
+        assert entry['page'] == index
+
+
+class BrokeMTurkClient(MTurkClient):
+    def create_hit(self, **params):
+        response = dict(Error=dict(Code='RequestError', Message='Insufficient funds'))
+        response['TurkErrorCode'] = 'AWS.MechanicalTurk.InsufficientFunds'
+        raise botocore.exceptions.ClientError(response, 'CreateHIT')
+
+
+def test_register_insufficient_funds(monkeypatch):
+    monkeypatch.setattr(
+        aws.ConnectionFactory,
+        'get_mturk_connection',
+        classmethod(lambda cls: BrokeMTurkClient()),
+    )
+    hit = model.RetypePageHIT('http://localhost/process')
+    with pytest.raises(errors.InsufficientFunds):
+        hit.register()
+    assert not hit.is_registered()
+
+
+def test_registration_claimed_once(sample_stream, monkeypatch):
+    use_store(monkeypatch, RecordingCollection())
+    job = model.MTurkConversionJob(
+        sample_stream, 'application/pdf', 'http://localhost/process'
+    )
+    job.claim_registration()
+    with pytest.raises(errors.RegistrationInProgress):
+        job.register_hits()
+    with pytest.raises(errors.RegistrationInProgress):
+        job.register_hits_async()
+    job.release_registration()
+    job.claim_registration()
+
+
+def test_legacy_hit_id():
+    hit = model.RetypePageHIT(None)
+    hit.registration_result = {
+        'py/object': 'boto.resultset.ResultSet',
+        'py/seq': [{'py/object': 'boto.mturk.connection.HIT', 'HITId': 'abc'}],
+    }
+    assert hit.id == 'abc'
+    assert hit.max_assignments() == 1
+
+
+def test_index_all_hits(monkeypatch):
+    hit = model.RetypePageHIT(None)
+    hit.registration_result = dict(HIT=dict(HITId='abc'))
+    job = model.MTurkConversionJob.__new__(model.MTurkConversionJob)
+    vars(job).update(
+        _hash='job', pages=pages.PageList(['p1']), hits=[hit], content_type='pdf'
+    )
+    jobs = types.SimpleNamespace(find=lambda query, projection: [dict(_id='job')])
+    hits = HitIndex()
+    store = types.SimpleNamespace(jobs=jobs, hits=hits)
+    monkeypatch.setattr(persistence, 'store', store, raising=False)
+    monkeypatch.setattr(
+        model.MTurkConversionJob, 'load', classmethod(lambda cls, id: job)
+    )
+    assert model.MTurkConversionJob.index_all_hits() == 1
+    assert model.MTurkConversionJob.locate_hit('abc')['page_ref'] == 'p1'
+    assert model.MTurkConversionJob.locate_hit('unknown') is None
@@ -0,0 +1,56 @@
+import types
+
+import botocore.exceptions
+import cherrypy
+
+from recapturedocs import aws, persistence, poller
+
+
+class MTurkClient:
+    def get_hit(self, HITId):
+        if HITId == 'gone':
+            error = {'Error': {'Code': 'RequestError', 'Message': 'No such HIT'}}
+            raise botocore.exceptions.ClientError(error, 'GetHIT')
+        return {'HIT': {'HITId': HITId, 'HITStatus': 'Assignable'}}
+
+    def list_assignments_for_hit(self, HITId):
+        return {'Assignments': []}
+
+
+class Cursor(list):
+    def sort(self, key, direction):
+        return self
+
+    def limit(self, count):
+        return Cursor(self[:count])
+
+
+class Hits:
+    def __init__(self, ids):
+        self.ids = ids
+        self.updates = {}
+
+    def find(self, query, projection):
+        return Cursor(dict(_id=id) for id in self.ids)
+
+    def bulk_write(self, requests, ordered=True):
+        for request in requests:
+            self.updates[request._filter['_id']] = request._doc['$set']
+
+
+def test_poll_records_failed_hits(monkeypatch):
+    client = MTurkClient()
+    monkeypatch.setattr(
+        aws.ConnectionFactory, 'get_mturk_connection', classmethod(lambda cls: client)
+    )
+    monkeypatch.setattr(aws, 'gateway', aws.Gateway(rate=100, backoff=0))
+    hits = Hits(['a', 'gone', 'b'])
+    monkeypatch.setattr(
+        persistence, 'store', types.SimpleNamespace(hits=hits), raising=False
+    )
+    poller.HITPoller(cherrypy.engine).poll()
+    assert sorted(hits.updates) == ['a', 'b', 'gone']
+    assert hits.updates['a']['status'] == 'Assignable'
+    assert hits.updates['a']['error'] is None
+    assert 'No such HIT' in hits.updates['gone']['error']
+    assert all('checked' in update for update in hits.updates.values())
@@ -0,0 +1,86 @@
+import io
+import wsgiref.util
+
+import cherrypy
+import pytest
+
+from recapturedocs import server
+
+page = b'0123456789'
+
+
+class PageServer(server.JobServer):
+    def _get_page(self, hit_id):
+        return 'application/pdf', '"abc"', page
+
+
+@pytest.fixture
+def get():
+    """
+    Request a page image through the WSGI application, returning the
+    status code, headers and body.
+    """
+    root = PageServer()
+    app = root._app = cherrypy.Application(root, config={'/': {}})
+
+    def get(**headers):
+        environ = dict(
+            PATH_INFO='/image', QUERY_STRING='hit_id=abc', SERVER_PROTOCOL='HTTP/1.1'
+        )
+        environ['wsgi.input'] = io.BytesIO()
+        wsgiref.util.setup_testing_defaults(environ)
+        for name, value in headers.items():
+            environ['HTTP_' + name.upper()] = value
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response.update(status=int(status.split()[0]), headers=dict(headers))
+
+        body = b''.join(app(environ, start_response))
+        return response['status'], response['headers'], body
+
+    return get
+
+
+def test_whole_page(get):
+    status, headers, body = get()
+    assert status == 200
+    assert body == page
+    assert headers['Accept-Ranges'] == 'bytes'
+    assert headers['Etag'] == '"abc"'
+    assert 'Content-Range' not in headers
+
+
+def test_single_range(get):
+    status, headers, body = get(range='bytes=2-4')
+    assert status == 206
+    assert body == b'234'
+    assert headers['Content-Range'] == 'bytes 2-4/10'
+
+
+def test_suffix_range(get):
+    status, headers, body = get(range='bytes=-3')
+    assert status == 206
+    assert body == b'789'
+    assert headers['Content-Range'] == 'bytes 7-9/10'
+
+
+def test_multiple_ranges_serve_whole_page(get):
+    status, headers, body = get(range='bytes=0-1,4-5')
+    assert status == 200
+    assert body == page
+
+
+def test_unsatisfiable_range(get):
+    status, headers, body = get(range='bytes=20-30')
+    assert status == 416
+    assert headers['Content-Range'] == 'bytes */10'
+
+
+def test_matching_etag(get):
+    status, headers, body = get(if_none_match='"abc"')
+    assert status == 304
+    assert body == b''
+    status, headers, body = get(if_none_match='"other"')
+    assert status == 200
+    assert body == page
@@ -0,0 +1,103 @@
+import io
+import types
+
+import cherrypy
+
+from recapturedocs import dropbox, model, persistence, sync
+
+
+class FakeClient:
+    def __init__(self, files, batches):
+        self.files = files
+        self.batches = batches
+        self.cursors = []
+
+    def delta(self, cursor=None):
+        self.cursors.append(cursor)
+        return self.batches[cursor]
+
+    def get_file(self, path):
+        return io.BytesIO(self.files[path])
+
+
+class FakeJob:
+    uploads = {}
+    saved = []
+
+    def __init__(self, stream, content_type, server_url, filename, upload_hash):
+        self.content = stream.read()
+        if not self.content.startswith(b'%PDF'):
+            raise ValueError("Not a PDF")
+        self.filename = filename
+        self.upload_hash = upload_hash
+        self.id = filename
+
+    hash_upload = staticmethod(model.ConversionJob.hash_upload)
+
+    @classmethod
+    def id_for_upload(cls, upload_hash):
+        return cls.uploads.get(upload_hash)
+
+    def save_if_new(self):
+        self.uploads[self.upload_hash] = self.id
+        self.saved.append(self.id)
+        return True
+
+
+class TokenCollection(dict):
+    def find(self):
+        return list(self.values())
+
+    def update_one(self, query, update):
+        self[query['_id']].update(update['$set'])
+
+
+def pdf(path):
+    return [path.lower(), dict(path=path, mime_type='application/pdf')]
+
+
+def test_sync_ingests_changed_pdfs(monkeypatch):
+    files = {
+        '/A.pdf': b'%PDF a',
+        '/b.pdf': b'%PDF b',
+        '/copy of b.pdf': b'%PDF b',
+        '/broken.pdf': b'junk',
+    }
+    batches = {
+        None: dict(
+            entries=[pdf('/A.pdf'), ['/notes', dict(path='/notes', is_dir=True)]],
+            cursor='1',
+            has_more=True,
+        ),
+        '1': dict(
+            entries=[pdf('/b.pdf'), pdf('/broken.pdf'), ['/gone.pdf', None]],
+            cursor='2',
+            has_more=False,
+        ),
+        '2': dict(entries=[pdf('/copy of b.pdf')], cursor='3', has_more=False),
+    }
+    client = FakeClient(files, batches)
+    tokens = TokenCollection(uid=dict(_id='uid', key='key', secret='secret'))
+    store = types.SimpleNamespace(dropbox=types.SimpleNamespace(tokens=tokens))
+    monkeypatch.setattr(persistence, 'store', store, raising=False)
+    monkeypatch.setattr(dropbox, 'load_client', lambda info: client)
+    monkeypatch.setattr(FakeJob, 'uploads', {})
+    monkeypatch.setattr(FakeJob, 'saved', [])
+    notices = []
+    worker = sync.DropboxSync(
+        cherrypy.engine,
+        'http://localhost/process',
+        notices.append,
+        job_class=FakeJob,
+    )
+
+    worker.sync()
+    assert FakeJob.saved == ['A.pdf', 'b.pdf']
+    assert len(notices) == 2
+    assert tokens['uid']['cursor'] == '2'
+
+    # the next sync resumes from the saved cursor; the copy is skipped
+    worker.sync()
+    assert client.cursors == [None, '1', '2']
+    assert FakeJob.saved == ['A.pdf', 'b.pdf']
+    assert tokens['uid']['cursor'] == '3'
@@ -0,0 +1,108 @@
+import io
+
+import cherrypy
+import gridfs
+import pymongo
+import pytest
+
+from recapturedocs import uploads
+
+
+class FakeQueue:
+    def __init__(self, entries):
+        self.entries = list(entries)
+        self.processed = []
+        self.failed = []
+
+    def claim(self):
+        return self.entries.pop(0) if self.entries else None
+
+    def process(self, entry, notify):
+        if entry.get('broken'):
+            raise ValueError("Not a PDF")
+        self.processed.append(entry['_id'])
+        notify(entry['_id'])
+
+    def fail(self, entry, error):
+        self.failed.append((entry['_id'], str(error)))
+
+
+def test_worker_processes_queue():
+    queue = FakeQueue([dict(_id='a'), dict(_id='b', broken=True), dict(_id='c')])
+    notices = []
+    uploads.UploadWorker(cherrypy.engine, queue, notices.append).work()
+    assert queue.processed == notices == ['a', 'c']
+    assert queue.failed == [('b', 'Not a PDF')]
+
+
+class Entries(dict):
+    def insert_one(self, doc):
+        if doc['_id'] in self:
+            raise pymongo.errors.DuplicateKeyError('duplicate')
+        self[doc['_id']] = dict(doc)
+
+    def update_one(self, query, update):
+        doc = self[query['_id']]
+        if all(doc.get(key) == value for key, value in query.items()):
+            doc.update(update['$set'])
+            for key in update.get('$unset', {}):
+                doc.pop(key, None)
+
+    def find_one_and_update(self, query, update, sort, return_document):
+        for doc in self.values():
+            if doc['status'] == query['status']:
+                doc.update(update['$set'])
+                doc['attempts'] += update['$inc']['attempts']
+                return dict(doc)
+        return None
+
+
+class Files(dict):
+    def put(self, stream, _id):
+        if _id in self:
+            raise gridfs.errors.FileExists()
+        self[_id] = stream.read()
+
+    def delete(self, _id):
+        del self[_id]
+
+
+@pytest.fixture
+def queue():
+    queue = uploads.UploadQueue.__new__(uploads.UploadQueue)
+    queue.entries = Entries()
+    queue.files = Files()
+    return queue
+
+
+def put(queue):
+    queue.put(io.BytesIO(b'%PDF'), 'application/pdf', '', 'a.pdf', 'a', object)
+
+
+def test_failed_after_max_attempts(queue):
+    put(queue)
+    for attempt in range(queue.max_attempts):
+        queue.fail(queue.claim(), ValueError("Not a PDF"))
+    assert queue.entries['a']['status'] == 'failed'
+    assert queue.entries['a']['error'] == "Not a PDF"
+    assert 'a' not in queue.files
+    assert queue.claim() is None
+
+
+def test_failed_after_worker_dies(queue):
+    put(queue)
+    for attempt in range(queue.max_attempts):
+        assert queue.claim()
+    assert queue.claim() is None
+    assert queue.entries['a']['status'] == 'failed'
+    assert 'a' not in queue.files
+
+
+def test_failed_upload_queued_again(queue):
+    put(queue)
+    queue._give_up(queue.claim(), ValueError())
+    put(queue)
+    assert queue.entries['a']['status'] == 'pending'
+    assert queue.entries['a']['attempts'] == 0
+    assert 'error' not in queue.entries['a']
+    assert queue.files['a'] == b'%PDF'